@@ -1,8 +1,7 @@
 from pathlib import Path
-import sys
 repo_root = Path(__file__).resolve().parents[2]
-sys.path.insert(0, str(repo_root / 'backend' / 'src'))
 from prompt_manager import format_system_instruction
+from prompt_build import build_prompt_with_rag
 
 OUTPUT = repo_root / 'backend' / 'output'
 OUTPUT.mkdir(parents=True, exist_ok=True)
@@ -29,21 +28,7 @@ retrieved_placeholder = [
     }
 ]
 
-# ローカルビルド関数（rag.build_prompt_with_rag と同等の出力を作る）
-def build_prompt_with_rag_local(system: str, history: list, user_input: str, retrieved_docs: list) -> str:
-    pieces = [f"{system}\n"] if system else []
-    if retrieved_docs:
-        pieces.append("【関連する講義情報】")
-        for i, doc in enumerate(retrieved_docs, 1):
-            pieces.append(f"講義{i}: {doc['text'][:1000]}")
-        pieces.append("-" * 20 + "\n")
-    pieces.append("これまでの対話:")
-    for role, text in history:
-        pieces.append(f"{role.capitalize()}: {text}")
-    pieces.append(f"User: {user_input}\nAssistant:")
-    return "\n".join(pieces)
-
-final = build_prompt_with_rag_local(system, history, user_input, retrieved_placeholder)
+final = build_prompt_with_rag(system, history, user_input, retrieved_placeholder, preview_len=1000)
 with OUTFILE.open('w', encoding='utf-8') as f:
     f.write(final)
 
@@ -1,9 +1,6 @@
-from pathlib import Path
-import sys
-repo_root = Path('/Users/toranosuke/Downloads/2025_M1_講義/M1秋/知識情報処理特論/duec')
-sys.path.insert(0, str(repo_root / 'backend' / 'src'))
+# backend/src から直接実行する想定（スクリプトのディレクトリは自動で sys.path に入る）
 from prompt_manager import format_system_instruction
-from rag import build_prompt_with_rag
+from prompt_build import build_prompt_with_rag
 
 system = format_system_instruction('default', '追加指示: 統合テスト用')
 
@@ -1,22 +1,6 @@
-from pathlib import Path
-import sys
-repo_root = Path('/Users/toranosuke/Downloads/2025_M1_講義/M1秋/知識情報処理特論/duec')
-sys.path.insert(0, str(repo_root / 'backend' / 'src'))
+# backend/src から直接実行する想定（スクリプトのディレクトリは自動で sys.path に入る）
 from prompt_manager import format_system_instruction
-
-
-def build_prompt_with_rag_local(system: str, history: list, user_input: str, retrieved_docs: list) -> str:
-    pieces = [f"{system}\n"] if system else []
-    if retrieved_docs:
-        pieces.append("【関連する講義情報】")
-        for i, doc in enumerate(retrieved_docs, 1):
-            pieces.append(f"講義{i}: {doc['text'][:300]}")
-        pieces.append("-" * 20 + "\n")
-    pieces.append("これまでの対話:")
-    for role, text in history:
-        pieces.append(f"{role.capitalize()}: {text}")
-    pieces.append(f"User: {user_input}\nAssistant:")
-    return "\n".join(pieces)
+from prompt_build import build_prompt_with_rag
 
 system = format_system_instruction('default', '追加指示: 統合テスト用（RAG非依存）')
 
@@ -35,5 +19,5 @@ history = [
 ]
 user_input = 'プログラミングが少ない授業を教えてください。'
 
-final = build_prompt_with_rag_local(system, history, user_input, retrieved)
+final = build_prompt_with_rag(system, history, user_input, retrieved)
 print(final)
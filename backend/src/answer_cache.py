@@ -0,0 +1,109 @@
+"""
+Answer-level cache for ChatSession.
+Reuses a previous reply when a new question is semantically close to a cached one
+and the retrieved evidence is almost the same, so the LLM call can be skipped.
+"""
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+# 実行をまたいで再利用するためのキャッシュファイル
+ANSWER_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "duec", "answer_cache.jsonl")
+
+
+def doc_key(doc) -> str:
+    """講義テキストから、実行をまたいで安定した文書IDを作る"""
+    return hashlib.blake2b(doc["text"].encode("utf-8"), digest_size=8).hexdigest()
+
+
+def context_key(model: str, system: str, history: list) -> str:
+    """モデル・システム指示・直近履歴が同じ場合にだけ一致するキーを作る"""
+    payload = json.dumps([model, system, [list(turn) for turn in history]], ensure_ascii=False)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def jaccard(a: frozenset, b: frozenset) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class AnswerCache:
+    """
+    直近 max_entries 件の (文脈キー, 質問ベクトル, 検索結果ID, 応答) を保持するキャッシュ。
+    ヒットの条件は次の2つをどちらも満たすこと:
+      1. 質問ベクトルのコサイン類似度が sim_threshold 以上
+      2. 検索結果の文書ID集合の Jaccard 係数が jaccard_threshold 以上
+    言い換えられた質問でも、根拠となる講義が変わった場合は再生成させるための安全策。
+    """
+    def __init__(self, path: str = ANSWER_CACHE_PATH, max_entries: int = 64,
+                 sim_threshold: float = 0.92, jaccard_threshold: float = 0.8):
+        self.path = path
+        self.max_entries = max_entries
+        self.sim_threshold = sim_threshold
+        self.jaccard_threshold = jaccard_threshold
+        self.entries = []  # list of (context, unit query vec, frozenset of doc ids, reply)
+        # 共有の ChatSession から複数スレッドで使われるので、一覧とファイルの読み書きを直列化する
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                all_lines = f.readlines()
+            lines = all_lines[-self.max_entries:]
+            # 追記のみだとファイルが肥大化するので、読み込み時に直近分だけへ詰める
+            if len(all_lines) > 2 * self.max_entries:
+                with open(self.path, "w", encoding="utf-8") as f:
+                    f.writelines(lines)
+            for line in lines:
+                item = json.loads(line)
+                vec = np.asarray(item["vec"], dtype=np.float32)
+                self.entries.append((item["context"], vec, frozenset(item["docs"]), item["reply"]))
+        except Exception as e:
+            print(f"Warning: failed to load answer cache {self.path}: {e}")
+            self.entries = []
+
+    @staticmethod
+    def _unit(vec) -> np.ndarray:
+        vec = np.asarray(vec, dtype=np.float32)
+        return vec / (np.linalg.norm(vec) + 1e-12)
+
+    def lookup(self, context: str, query_vec, doc_ids) -> str:
+        """条件を満たす最も類似したエントリの応答を返す。なければ None"""
+        q = self._unit(query_vec)
+        docs = frozenset(doc_ids)
+        best_sim, best_reply = -1.0, None
+        with self._lock:
+            for ctx, vec, cached_docs, reply in self.entries:
+                if ctx != context:
+                    continue
+                sim = float(np.dot(vec, q))
+                if sim > best_sim and jaccard(docs, cached_docs) >= self.jaccard_threshold:
+                    best_sim, best_reply = sim, reply
+        if best_sim >= self.sim_threshold:
+            return best_reply
+        return None
+
+    def add(self, context: str, query_vec, doc_ids, reply: str):
+        """エントリを追加し、ファイルにも追記する（古いものから捨てる）"""
+        q = self._unit(query_vec)
+        docs = frozenset(doc_ids)
+        with self._lock:
+            self.entries.append((context, q, docs, reply))
+            if len(self.entries) > self.max_entries:
+                self.entries = self.entries[-self.max_entries:]
+            if not self.path:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    record = {"context": context, "vec": q.tolist(), "docs": sorted(docs), "reply": reply}
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            except OSError as e:
+                print(f"Warning: failed to write answer cache {self.path}: {e}")
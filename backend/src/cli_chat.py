@@ -4,77 +4,343 @@ Simple CLI chat that uses langchain's Ollama LLM if available,
 otherwise falls back to calling the `ollama` CLI.
 """
 import argparse
+import asyncio
+import collections
+import importlib.util
+import json
+import os
 import subprocess
-import sys
 import shutil
-from rag import load_course_db_from_csv, load_course_db, retrieve, build_prompt_with_rag, prepare_tfidf_index, retrieve_tfidf
-from prompt_manager import load_prompt_template, list_available_prompts, format_system_instruction
+import tempfile
+import threading
+from rag import load_course_db_from_csv, load_course_db, retrieve, prepare_tfidf_index, retrieve_tfidf, encode_query
+from prompt_build import build_prompt, build_prompt_with_rag, build_rag_prefix
+from prompt_manager import list_available_prompts, format_system_instruction
+from answer_cache import AnswerCache, context_key, doc_key
 
-# Try to import langchain's Ollama wrapper if available
+__all__ = [
+    "ChatSession",
+    "generate",
+    "generate_stream",
+    "agenerate",
+    "run_with_ollama_client",
+    "run_with_ollama_http",
+    "run_with_langchain",
+    "run_with_ollama_cli",
+    "build_prompt",
+    "normalize_query",
+    "main",
+]
+
+# langchain's Ollama wrapper is heavy to import (pydantic, httpx, ...), so only check that it
+# is installed here and import it on first use in create_langchain_llm().
+LANGCHAIN_AVAILABLE = importlib.util.find_spec("langchain_ollama") is not None
+
+# Try to import the official ollama client (direct API access and concurrent batch generation)
+try:
+    from ollama import AsyncClient, Client  # type: ignore
+    OLLAMA_CLIENT_AVAILABLE = True
+except Exception:
+    AsyncClient = Client = None  # type: ignore
+    OLLAMA_CLIENT_AVAILABLE = False
+
+# requests is used for the plain HTTP fallback (one keep-alive connection reused across turns)
 try:
-    from langchain_ollama import OllamaLLM # type: ignore
-    LANGCHAIN_AVAILABLE = True
+    import requests  # type: ignore
+    REQUESTS_AVAILABLE = True
 except Exception:
-    OllamaLLM = None  # type: ignore
-    LANGCHAIN_AVAILABLE = False
+    requests = None  # type: ignore
+    REQUESTS_AVAILABLE = False
+
+# Absolute path of the ollama CLI, resolved once (None when it is not on PATH)
+_OLLAMA_BIN = shutil.which("ollama")
+
+# How long the ollama server keeps the model (and its prompt KV cache) loaded between turns
+OLLAMA_KEEP_ALIVE = "1h"
+# Fixed context size so the server never has to reload the model with a different num_ctx
+OLLAMA_NUM_CTX = 4096
+
+_ollama_client = None
+
 
+def get_ollama_client():
+    """遅延初期化された ollama.Client を返す。HTTP接続はターン間で使い回される。"""
+    global _ollama_client
+    if _ollama_client is None:
+        _ollama_client = Client()
+    return _ollama_client
 
-def run_with_langchain(model: str, prompt: str) -> str:
-    """Use langchain's Ollama wrapper to generate text."""
-    if not LANGCHAIN_AVAILABLE:
+
+def run_with_ollama_client(model: str, prompt: str) -> str:
+    """Call the ollama HTTP API directly, keeping the model (and prompt cache) warm."""
+    if not OLLAMA_CLIENT_AVAILABLE:
+        raise RuntimeError("ollama python client not available")
+    res = get_ollama_client().generate(
+        model=model, prompt=prompt, keep_alive=OLLAMA_KEEP_ALIVE, options={"num_ctx": OLLAMA_NUM_CTX}
+    )
+    return res["response"]
+
+
+def create_langchain_llm(model: str):
+    """Build a reusable langchain Ollama wrapper with a pinned context size."""
+    try:
+        from langchain_ollama import OllamaLLM  # type: ignore
+    except ImportError:
         raise RuntimeError("langchain Ollama not available")
-    llm = OllamaLLM(model=model)
+    return OllamaLLM(model=model, keep_alive=OLLAMA_KEEP_ALIVE, num_ctx=OLLAMA_NUM_CTX)
+
+
+class LazyLangchainLLM:
+    """create_langchain_llm() の結果を初回の呼び出し時に作り、以後は使い回すラッパー。
+
+    ollama クライアントが使える環境では langchain は予備の経路なので、
+    実際にその経路へ落ちるまで import もインスタンス生成も行わない。
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+        self._llm = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._llm is None:
+                self._llm = create_langchain_llm(self.model)
+            return self._llm
+
+    def invoke(self, prompt: str):
+        return self.get().invoke(prompt)
+
+    def stream(self, prompt: str):
+        return self.get().stream(prompt)
+
+
+def _ollama_base_url() -> str:
+    """OLLAMA_HOST（ollama 本体と同じ環境変数）から API のベースURLを組み立てる"""
+    host = os.environ.get("OLLAMA_HOST", "127.0.0.1:11434")
+    if not host.startswith(("http://", "https://")):
+        host = f"http://{host}"
+    return host.rstrip("/")
+
+
+_http_session = None
+
+
+def get_http_session():
+    """遅延初期化された requests.Session を返す。TCP接続はターン間で使い回される。"""
+    global _http_session
+    if _http_session is None:
+        _http_session = requests.Session()
+    return _http_session
+
+
+def _ollama_http_payload(model: str, prompt: str, stream: bool) -> dict:
+    return {
+        "model": model,
+        "prompt": prompt,
+        "stream": stream,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": {"num_ctx": OLLAMA_NUM_CTX},
+    }
+
+
+def run_with_ollama_http(model: str, prompt: str) -> str:
+    """Fallback: POST to the ollama REST API over a persistent keep-alive session."""
+    if not REQUESTS_AVAILABLE:
+        raise RuntimeError("requests not available")
+    res = get_http_session().post(
+        f"{_ollama_base_url()}/api/generate", json=_ollama_http_payload(model, prompt, False), timeout=600
+    )
+    res.raise_for_status()
+    return res.json()["response"]
+
+
+def run_with_ollama_http_stream(model: str, prompt: str):
+    """Fallback: stream reply chunks from the ollama REST API (newline-delimited JSON)."""
+    if not REQUESTS_AVAILABLE:
+        raise RuntimeError("requests not available")
+    with get_http_session().post(
+        f"{_ollama_base_url()}/api/generate", json=_ollama_http_payload(model, prompt, True), stream=True, timeout=600
+    ) as res:
+        res.raise_for_status()
+        for line in res.iter_lines():
+            if line:
+                yield json.loads(line).get("response", "")
+
+
+def run_with_langchain(model: str, prompt: str, llm=None) -> str:
+    """Use langchain's Ollama wrapper to generate text (reusing `llm` when given)."""
+    if llm is None:
+        llm = create_langchain_llm(model)
     return llm.invoke(prompt)
 
 
+def _decode_cli_output(data: bytes) -> str:
+    return (data or b"").decode("utf-8", errors="replace").strip()
+
+
 def run_with_ollama_cli(model: str, prompt: str) -> str:
     """Fallback: call the `ollama` CLI."""
-    if shutil.which("ollama") is None:
+    if _OLLAMA_BIN is None:
         raise RuntimeError("ollama CLI not found in PATH; please install ollama or use langchain.")
     
-    cmd_with_prompt = ["ollama", "run", model, "--prompt", prompt]
+    cmd_with_prompt = [_OLLAMA_BIN, "run", model, "--prompt", prompt]
+    # 出力はバイト列のまま受け取り、最後に一度だけデコードする（不正なバイトは置換）
     try:
-        res = subprocess.run(cmd_with_prompt, capture_output=True, text=True, check=True, encoding="utf-8",errors="strict")
-        return res.stdout.strip()
+        res = subprocess.run(cmd_with_prompt, capture_output=True, check=True)
+        return _decode_cli_output(res.stdout)
     except subprocess.CalledProcessError as e:
-        stderr = (e.stderr or "").lower()
-        stdout = (e.stdout or "").lower()
-        combined = "\\n".join([stdout, stderr]).strip()
+        stderr = _decode_cli_output(e.stderr).lower()
+        stdout = _decode_cli_output(e.stdout).lower()
+        combined = "\n".join([stdout, stderr]).strip()
         
         if "unknown flag" in combined or "unrecognized option" in combined or "--prompt" in combined:
-            cmd_stdin = ["ollama", "run", model]
+            cmd_stdin = [_OLLAMA_BIN, "run", model]
             try:
-                res2 = subprocess.run(cmd_stdin, input=prompt, capture_output=True, text=True, check=True,encoding="utf-8",errors="strict")
-                return res2.stdout.strip()
+                res2 = subprocess.run(cmd_stdin, input=prompt.encode("utf-8"), capture_output=True, check=True)
+                return _decode_cli_output(res2.stdout)
             except subprocess.CalledProcessError as e2:
-                out2 = e2.stdout.strip() if e2.stdout else e2.stderr.strip()
+                out2 = _decode_cli_output(e2.stdout) or _decode_cli_output(e2.stderr)
                 raise RuntimeError(f"ollama CLI failed (fallback stdin): {out2}")
         raise RuntimeError(f"ollama CLI failed: {combined}")
 
 
-def generate(model: str, prompt: str, prefer_langchain: bool = True) -> str:
-    """Generate model output trying langchain first, falling back to CLI."""
+def backend_order(prefer_langchain: bool = True) -> list:
+    """Names of the backends generate()/generate_stream() will try, in order."""
+    names = []
+    if prefer_langchain and OLLAMA_CLIENT_AVAILABLE:
+        names.append("ollama client")
     if prefer_langchain and LANGCHAIN_AVAILABLE:
+        names.append("langchain Ollama wrapper")
+    if REQUESTS_AVAILABLE:
+        names.append("ollama HTTP API")
+    names.append("ollama CLI" if _OLLAMA_BIN else "ollama CLI (not found in PATH)")
+    return names
+
+
+def generate(model: str, prompt: str, prefer_langchain: bool = True, llm=None) -> str:
+    """Generate model output trying the ollama client, then langchain, falling back to CLI."""
+    if prefer_langchain and OLLAMA_CLIENT_AVAILABLE:
         try:
-            return run_with_langchain(model, prompt)
+            return run_with_ollama_client(model, prompt)
+        except Exception:
+            pass
+    if prefer_langchain and LANGCHAIN_AVAILABLE:
+        try:
+            return run_with_langchain(model, prompt, llm=llm)
+        except Exception:
+            pass
+    # プロセスを毎ターン起動する CLI より先に、接続を使い回せる HTTP API を試す
+    if REQUESTS_AVAILABLE:
+        try:
+            return run_with_ollama_http(model, prompt)
         except Exception:
             pass
     return run_with_ollama_cli(model, prompt)
 
 
-def build_prompt(system: str, history: list, user_input: str) -> str:
-    """Simple prompt assembly."""
-    pieces = []
-    if system:
-        pieces.append(f"{system}\n\n")
-    pieces.append("Conversation:\n")
-    for role, text in history:
-        if role == "user":
-            pieces.append(f"User: {text}\n")
-        else:
-            pieces.append(f"Assistant: {text}\n")
-    pieces.append(f"User: {user_input}\nAssistant:")
-    return "".join(pieces)
+def run_with_ollama_client_stream(model: str, prompt: str):
+    """Stream reply chunks from the ollama HTTP API as they are generated."""
+    if not OLLAMA_CLIENT_AVAILABLE:
+        raise RuntimeError("ollama python client not available")
+    stream = get_ollama_client().generate(
+        model=model, prompt=prompt, stream=True, keep_alive=OLLAMA_KEEP_ALIVE, options={"num_ctx": OLLAMA_NUM_CTX}
+    )
+    for chunk in stream:
+        yield chunk["response"]
+
+
+def run_with_langchain_stream(model: str, prompt: str, llm=None):
+    """Stream reply chunks through langchain's Ollama wrapper."""
+    if llm is None:
+        llm = create_langchain_llm(model)
+    yield from llm.stream(prompt)
+
+
+def run_with_ollama_cli_stream(model: str, prompt: str):
+    """Fallback: stream the `ollama` CLI output line by line (prompt is fed via stdin)."""
+    if _OLLAMA_BIN is None:
+        raise RuntimeError("ollama CLI not found in PATH; please install ollama or use langchain.")
+
+    # stderr（スピナーや進捗表示）はパイプにすると読まれないまま詰まり得るので、一時ファイルに逃がす
+    with tempfile.TemporaryFile() as stderr_file:
+        proc = subprocess.Popen(
+            [_OLLAMA_BIN, "run", model],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr_file,
+            text=True, encoding="utf-8", errors="replace",
+        )
+        try:
+            proc.stdin.write(prompt)
+            proc.stdin.close()
+            for line in proc.stdout:
+                yield line
+            returncode = proc.wait()
+        finally:
+            # 呼び出し側が途中で読むのをやめた場合（クライアント切断など）も子プロセスを終了させて回収する
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            proc.stdout.close()
+        if returncode != 0:
+            stderr_file.seek(0)
+            stderr = stderr_file.read().decode("utf-8", errors="replace")
+            raise RuntimeError(f"ollama CLI failed: {stderr.strip()}")
+
+
+def generate_stream(model: str, prompt: str, prefer_langchain: bool = True, llm=None):
+    """
+    Stream model output chunk by chunk, trying backends in the same order as generate().
+    A backend that fails before producing any output falls through to the next one.
+    """
+    backends = []
+    if prefer_langchain and OLLAMA_CLIENT_AVAILABLE:
+        backends.append(lambda: run_with_ollama_client_stream(model, prompt))
+    if prefer_langchain and LANGCHAIN_AVAILABLE:
+        backends.append(lambda: run_with_langchain_stream(model, prompt, llm=llm))
+    if REQUESTS_AVAILABLE:
+        backends.append(lambda: run_with_ollama_http_stream(model, prompt))
+    backends.append(lambda: run_with_ollama_cli_stream(model, prompt))
+
+    for i, start in enumerate(backends):
+        started = False
+        try:
+            for chunk in start():
+                started = True
+                yield chunk
+            return
+        except Exception:
+            if started or i == len(backends) - 1:
+                raise
+
+
+async def _agen(model: str, prompt: str, client) -> str:
+    """Generate a single reply through a shared ollama AsyncClient."""
+    res = await client.generate(
+        model=model, prompt=prompt, keep_alive=OLLAMA_KEEP_ALIVE, options={"num_ctx": OLLAMA_NUM_CTX}
+    )
+    return res["response"]
+
+
+async def agenerate(model: str, prompts: list) -> list:
+    """
+    複数のプロンプトを ollama.AsyncClient で同時に投げ、入力順に応答を返す。
+    サーバー側では OLLAMA_NUM_PARALLEL 件まで並行に処理される。
+    失敗したプロンプトは例外オブジェクトとして返す。
+    """
+    if not OLLAMA_CLIENT_AVAILABLE:
+        raise RuntimeError("ollama python client not available")
+    # 全プロンプトで1つのクライアント（接続プール）を共有し、終わったら閉じる
+    async with AsyncClient() as client:
+        return await asyncio.gather(*[_agen(model, p, client) for p in prompts], return_exceptions=True)
+
+
+# ChatSession が保持する検索結果キャッシュの最大件数（超えたら古いものから捨てる）
+RETRIEVAL_CACHE_SIZE = 256
+
+
+def normalize_query(query: str) -> str:
+    """検索結果キャッシュのキー用に、大文字小文字と空白の揺れを吸収する"""
+    return " ".join(query.lower().split())
 
 
 # --- 変更点: ChatSessionクラスの追加 ---
@@ -82,11 +348,26 @@ class ChatSession:
     """
     対話の状態(履歴, 設定, RAGインデックス)を保持し、
     入力を受け取って応答を返す機能を提供するクラス
+
+    システムプロンプトの読み込み・整形結果は prompt_manager 側でキャッシュされるため、
+    複数のセッションを作っても2回目以降はファイルを読みません。
+    テンプレートを編集した場合は prompt_manager.reload() を呼んでください。
     """
     def __init__(self, args):
         self.args = args
-        self.history = []  # list of (role, text)
+        # list of (role, text)。プロンプトに使うのは直近 history_size 件だけなので、
+        # それより古い発言は追記時に自動で捨てる（history_size が 0 の場合は従来どおり無制限）
+        self.history = collections.deque(maxlen=args.history_size or None)
+        # 内部履歴に含まれるユーザー発言（古い順）と、それを ", " で連結したもの。
+        # 検索クエリの組み立て用に、ユーザー発言が増減したときだけ作り直す
+        self._hist_user_list = collections.deque()
+        self._hist_user_text = ""
         self.prefer_langchain = not args.no_langchain
+
+        # langchain の Ollama ラッパーはターンごとに作らず、セッション内で使い回す。
+        # 作成は langchain の経路を初めて使うときまで遅らせる（ollama クライアントが使える場合は予備の経路）
+        use_langchain = self.prefer_langchain and LANGCHAIN_AVAILABLE
+        self._llm = LazyLangchainLLM(args.model) if use_langchain else None
         
         # System instruction preparation
         self.system_instruction = format_system_instruction(args.prompt_template, args.system)
@@ -96,29 +377,139 @@ class ChatSession:
         self.course_db_wrapper = None
         self.rag_index = None
 
+        # 直前ターンのプロンプト先頭部分（システム指示 + 検索結果）。
+        # 検索結果が変わらなければ同一文字列を使い回し、Ollama のプロンプトキャッシュを効かせる
+        self._rag_prefix_key = None
+        self._rag_prefix = ""
+
+        # 正規化したクエリ -> 検索結果。DBを読み込み直したら破棄する
+        self._retrieval_cache = {}
+        # サーバーでは1つのセッションを複数スレッドで共有するため、
+        # 検索結果キャッシュとプロンプト先頭部分のキャッシュはこのロックの中でだけ読み書きする
+        self._cache_lock = threading.Lock()
+
+        # 応答キャッシュ（--answer-cache 指定時のみ）。言い換えを含む同じ質問への再生成を省く
+        self.answer_cache = AnswerCache() if getattr(args, "answer_cache", False) else None
+
         if args.rag:
-            print(f"Loading RAG DB from: {args.rag_db}")
-            
-            # 拡張子で分岐
-            if args.rag_db.endswith('.csv'):
-                print("Detected CSV format for RAG DB.")
-                self.course_db_wrapper = load_course_db_from_csv(args.rag_db)
-            else:
-                self.course_db_wrapper = load_course_db(args.rag_db)
+            self.load_rag_db()
+
+    def load_rag_db(self):
+        """RAG DBとインデックスを（再）読み込みし、検索結果とプロンプト先頭部分のキャッシュを破棄する"""
+        args = self.args
+        with self._cache_lock:
+            self._retrieval_cache.clear()
+            self._rag_prefix_key = None
+            self._rag_prefix = ""
+        self.course_db_wrapper = None
+        self.rag_index = None
+
+        print(f"Loading RAG DB from: {args.rag_db}")
+        
+        # 拡張子で分岐
+        if args.rag_db.endswith('.csv'):
+            print("Detected CSV format for RAG DB.")
+            self.course_db_wrapper = load_course_db_from_csv(args.rag_db)
+        else:
+            self.course_db_wrapper = load_course_db(args.rag_db)
+        
+        if self.course_db_wrapper is None:
+            print(f"RAG DB not found or invalid at {args.rag_db}; continuing without RAG.")
+            self.args.rag = False
+        else:
+            if args.rag_method == "tfidf":
+                self.rag_index = prepare_tfidf_index(self.course_db_wrapper)
+                if self.rag_index is None:
+                    print("TF-IDF index could not be prepared. Falling back to simple retrieval.")
+                    self.args.rag_method = "simple"
+                else:
+                    print(f"RAG index cache: {'hit' if self.rag_index.get('cache_hit') else 'miss'}")
+
+    def _retrieve(self, combined_query: str) -> list:
+        """検索結果キャッシュを確認し、なければ検索を実行して結果を記録する"""
+        key = (normalize_query(combined_query), self.args.rag_k, self.args.rag_method)
+        with self._cache_lock:
+            cached = self._retrieval_cache.get(key)
+        if cached is not None:
+            return cached
+
+        if self.args.rag_method == "tfidf" and self.rag_index is not None:
+            retrieved = retrieve_tfidf(combined_query, self.rag_index, k=self.args.rag_k)
+        else:
+            retrieved = retrieve(combined_query, self.course_db_wrapper, k=self.args.rag_k)
+
+        with self._cache_lock:
+            if key not in self._retrieval_cache and len(self._retrieval_cache) >= RETRIEVAL_CACHE_SIZE:
+                # dict は挿入順を保持するので、先頭が最も古いエントリ
+                del self._retrieval_cache[next(iter(self._retrieval_cache))]
+            self._retrieval_cache[key] = retrieved
+        return retrieved
+
+    def _append_history(self, role: str, text: str):
+        """内部履歴に1件追記し、検索クエリ用のユーザー発言テキストを更新する"""
+        changed = False
+        # 上限に達していれば追記で先頭の1件が押し出される。それがユーザー発言なら一覧からも外す
+        if len(self.history) == self.history.maxlen and self.history[0][0] == "user":
+            self._hist_user_list.popleft()
+            changed = True
+        self.history.append((role, text))
+        if role == "user":
+            self._hist_user_list.append(text)
+            changed = True
+        if changed:
+            self._hist_user_text = ", ".join(self._hist_user_list)
+
+    def _get_rag_prefix(self, retrieved: list) -> str:
+        """検索結果の組が前回と同じなら、前回と同一のプロンプト先頭部分を返す"""
+        # id() は DB を読み込み直すと別の講義に再利用され得るので、本文から作る安定した ID をキーにする
+        key = (self.system_instruction, tuple(doc_key(doc) for doc in retrieved))
+        # キーと先頭部分の更新・返却を同じロックの中で行い、他のリクエストの検索結果が混ざらないようにする
+        with self._cache_lock:
+            if key != self._rag_prefix_key:
+                self._rag_prefix_key = key
+                self._rag_prefix = build_rag_prefix(self.system_instruction, retrieved)
+            return self._rag_prefix
+
+    def _trim_history(self, active_history):
+        """直近 history_size 件の履歴を返す。内部履歴は deque で上限済みなのでそのまま使う"""
+        if active_history is self.history:
+            return active_history
+        return list(active_history)[-self.args.history_size:]
+
+    def _build_turn_prompt(self, user_input: str, active_history: list):
+        """履歴とRAG検索結果から1ターン分のプロンプトを組み立て、(prompt, 検索結果) を返す"""
+        # Build prompt from system + last N history turns
+        trimmed_history = self._trim_history(active_history)
+
+        if active_history is self.history:
+            history_user_text = self._hist_user_text
+        else:
+            history_user_text = ", ".join(msg for role, msg in trimmed_history if role == "user")
+        combined_query = f"{history_user_text}\n{user_input}" if history_user_text else user_input
+        
+        # RAG or Normal Prompt Building
+        retrieved = []
+        if self.args.rag:
+            retrieved = self._retrieve(combined_query)
             
-            if self.course_db_wrapper is None:
-                print(f"RAG DB not found or invalid at {args.rag_db}; continuing without RAG.")
-                self.args.rag = False
-            else:
-                if args.rag_method == "tfidf":
-                    self.rag_index = prepare_tfidf_index(self.course_db_wrapper)
-                    if self.rag_index is None:
-                        print("TF-IDF index could not be prepared. Falling back to simple retrieval.")
-                        self.args.rag_method = "simple"
+            prefix = self._get_rag_prefix(retrieved)
+            prompt = build_prompt_with_rag(self.system_instruction, trimmed_history, user_input, retrieved, prefix=prefix)
+        else:
+            prompt = build_prompt(self.system_instruction, trimmed_history, user_input)
+        return prompt, retrieved
+
+    def _answer_cache_key(self, user_input: str, active_history: list, retrieved: list):
+        """応答キャッシュの照会キー (文脈キー, 質問ベクトル, 検索結果ID) を返す。使わない場合は None"""
+        # 質問ベクトルにはインデックスと同じ埋め込みモデルを使うので、ベクトル検索時のみ有効
+        if self.answer_cache is None or self.rag_index is None:
+            return None
+        trimmed_history = self._trim_history(active_history)
+        context = context_key(self.args.model, self.system_instruction, trimmed_history)
+        return context, encode_query(user_input), [doc_key(doc) for doc in retrieved]
 
     # cli_chat.py の ChatSession クラス内を変更
 
-    def chat(self, user_input: str, history: list = None) -> str:
+    def chat(self, user_input: str, history: list = None, stream: bool = False):
         """
         ユーザー入力を受け取り、AIの応答を返す関数
         
@@ -127,50 +518,105 @@ class ChatSession:
             history (list, optional): 外部から履歴を渡す場合に使用。
                                     形式: [("user", "こんにちは"), ("assistant", "はい")]
                                     Noneの場合はクラス内部の履歴(self.history)を使用します。
+            stream (bool, optional): True の場合、応答を生成された順に少しずつ返す
+                                    ジェネレーターを返します。内部履歴は最後まで読み切った時点で更新されます。
         """
+        if stream:
+            return self._chat_stream(user_input, history)
+
         # 1. 履歴の決定: 外部指定があればそれを使い、なければ内部履歴を使う
         if history is None:
             active_history = self.history
         else:
             active_history = history
 
-        # Build prompt from system + last N history turns
-        trimmed_history = active_history[-self.args.history_size:]
-
-        user_messages = [msg for role, msg in trimmed_history if role == "user"]
-        history_user_text = ", ".join(user_messages)
-        combined_query = f"{history_user_text}\n{user_input}" if history_user_text else user_input
-        
-        # RAG or Normal Prompt Building
-        if self.args.rag:
-            if self.args.rag_method == "tfidf" and self.rag_index is not None:
-                retrieved = retrieve_tfidf(combined_query, self.rag_index, k=self.args.rag_k)
-            else:
-                retrieved = retrieve(combined_query, self.course_db_wrapper, k=self.args.rag_k)
-            
-            prompt = build_prompt_with_rag(self.system_instruction, trimmed_history, user_input, retrieved)
-        else:
-            prompt = build_prompt(self.system_instruction, trimmed_history, user_input)
+        prompt, retrieved = self._build_turn_prompt(user_input, active_history)
+        cache_key = self._answer_cache_key(user_input, active_history, retrieved)
+        reply = self.answer_cache.lookup(*cache_key) if cache_key else None
 
         # Generation
-        try:
-            reply = generate(self.args.model, prompt, prefer_langchain=self.prefer_langchain)
-        except Exception as e:
-            return f"Error generating response: {str(e)}"
+        if reply is None:
+            try:
+                # ストリーミング版（_chat_stream）と同じく前後の空白を除いてから履歴・キャッシュに入れる
+                reply = generate(self.args.model, prompt, prefer_langchain=self.prefer_langchain, llm=self._llm).strip()
+            except Exception as e:
+                return f"Error generating response: {str(e)}"
+            if cache_key:
+                self.answer_cache.add(*cache_key, reply)
 
         # 2. 履歴の更新: 
         # 内部履歴を使っている場合のみ、自動で追記する。
         # 外部履歴(history)を渡した場合は、呼び出し元で管理してもらうためここでは追記しない。
         if history is None:
-            self.history.append(("user", user_input))
-            self.history.append(("assistant", reply))
+            self._append_history("user", user_input)
+            self._append_history("assistant", reply)
         
         return reply
+
+    def _chat_stream(self, user_input: str, history: list = None):
+        """chat(stream=True) の本体。応答の断片を yield し、完了後に内部履歴を更新する"""
+        active_history = self.history if history is None else history
+        prompt, retrieved = self._build_turn_prompt(user_input, active_history)
+        cache_key = self._answer_cache_key(user_input, active_history, retrieved)
+        reply = self.answer_cache.lookup(*cache_key) if cache_key else None
+
+        if reply is not None:
+            yield reply
+        else:
+            chunks = []
+            try:
+                for chunk in generate_stream(self.args.model, prompt, prefer_langchain=self.prefer_langchain, llm=self._llm):
+                    chunks.append(chunk)
+                    yield chunk
+            except Exception as e:
+                yield f"Error generating response: {str(e)}"
+                return
+            reply = "".join(chunks).strip()
+            if cache_key:
+                self.answer_cache.add(*cache_key, reply)
+
+        if history is None:
+            self._append_history("user", user_input)
+            self._append_history("assistant", reply)
+
+    def chat_batch(self, inputs: list, history: list = None) -> list:
+        """
+        複数のユーザー入力をまとめて処理し、入力順に応答を返す関数。
+        各入力は同じ履歴に対する独立したターンとして扱い、履歴は更新しない。
+        ollama の Python クライアントがあれば全プロンプトを並行に送信する。
+        """
+        active_history = self.history if history is None else history
+        prompts = [self._build_turn_prompt(user_input, active_history)[0] for user_input in inputs]
+
+        if not (self.prefer_langchain and OLLAMA_CLIENT_AVAILABLE):
+            return [self._generate_or_error(prompt) for prompt in prompts]
+
+        try:
+            results = asyncio.run(agenerate(self.args.model, prompts))
+        except Exception as e:
+            return [f"Error generating response: {str(e)}" for _ in prompts]
+        return [
+            f"Error generating response: {str(r)}" if isinstance(r, Exception) else r
+            for r in results
+        ]
+
+    def _generate_or_error(self, prompt: str) -> str:
+        try:
+            return generate(self.args.model, prompt, prefer_langchain=self.prefer_langchain, llm=self._llm)
+        except Exception as e:
+            return f"Error generating response: {str(e)}"
 # ------------------------------------
 
 
 def main():
-    parser = argparse.ArgumentParser(description="Simple CLI chat using local ollama model")
+    parser = argparse.ArgumentParser(
+        description="Simple CLI chat using local ollama model",
+        epilog=(
+            "Server-side concurrency for batch generation (ChatSession.chat_batch) is controlled by "
+            "the ollama server environment: OLLAMA_NUM_PARALLEL (parallel requests per model) and "
+            "OLLAMA_MAX_LOADED_MODELS (models kept in memory at once)."
+        ),
+    )
     parser.add_argument("--model", default="dsasai/llama3-elyza-jp-8b", help="Ollama model name")
     parser.add_argument("--system", default="", help="Optional system prompt")
     available_prompts = " | ".join(list_available_prompts()) or "default"
@@ -181,15 +627,16 @@ def main():
     parser.add_argument("--rag-db", default="../database/syllabus_インテリ.json", help="Path to JSON DB")
     parser.add_argument("--rag-k", type=int, default=3, help="RAG retrieval count")
     parser.add_argument("--rag-method", choices=["tfidf", "simple"], default="tfidf", help="RAG method")
+    parser.add_argument("--answer-cache", action="store_true", help="Reuse replies for repeated/paraphrased questions (tfidf RAG only)")
     args = parser.parse_args()
 
-    # Log environment status
-    if not args.no_langchain and LANGCHAIN_AVAILABLE:
-        print("Using langchain Ollama wrapper.")
-    elif not args.no_langchain and not LANGCHAIN_AVAILABLE:
-        print("langchain Ollama wrapper not available; will use ollama CLI fallback.")
-    else:
-        print("Forcing ollama CLI usage (no-langchain).")
+    # Log environment status (the backend tried first, then its fallbacks in order)
+    backends = backend_order(prefer_langchain=not args.no_langchain)
+    print(f"Using {backends[0]}.")
+    if len(backends) > 1:
+        print(f"Fallbacks: {' -> '.join(backends[1:])}")
+    if args.no_langchain:
+        print("ollama client / langchain disabled (no-langchain).")
     
     # --- 変更点: クラスのインスタンス化とチャットループ ---
     
@@ -212,10 +659,11 @@ def main():
                 print("Goodbye.")
                 break
 
-            # クラスのメソッド（関数）を呼び出して応答を取得
-            reply = bot.chat(user_input)
-            
-            print("\nAssistant:", reply)
+            # クラスのメソッド（関数）を呼び出し、生成された順に応答を表示
+            print("\nAssistant: ", end="", flush=True)
+            for chunk in bot.chat(user_input, stream=True):
+                print(chunk, end="", flush=True)
+            print()
 
     except KeyboardInterrupt:
         print("\nInterrupted. Bye.")
@@ -0,0 +1,73 @@
+"""
+Prompt assembly module.
+Builds the final LLM prompt from the system instruction, retrieved course docs and history.
+Kept free of heavy dependencies (torch / FlagEmbedding / langchain) so scripts that only
+need to render prompts can import it cheaply.
+"""
+
+import sys
+
+# プロンプトに載せる講義テキストの長さ（読み込み時に切り出して doc["preview"] に保持する）
+PREVIEW_LEN = 300
+
+
+def build_prompt(system: str, history: list, user_input: str) -> str:
+    """Simple prompt assembly (one line per turn, joined once)."""
+    pieces = []
+    if system:
+        pieces.append(system)
+        pieces.append("")
+    pieces.append("Conversation:")
+    pieces.extend(f"{'User' if role == 'user' else 'Assistant'}: {text}" for role, text in history)
+    pieces.append(f"User: {user_input}")
+    pieces.append("Assistant:")
+    return "\n".join(pieces)
+
+
+# 毎回同じになる見出し・区切りは文字列定数として使い回す
+_RAG_HEADER = "【関連する講義情報】\n"
+_RAG_FOOTER = "-" * 20 + "\n"
+_HISTORY_HEADER = "これまでの対話:\n"
+# role -> 履歴の行頭ラベル
+_ROLE_LABELS = {role: sys.intern(f"{role.capitalize()}: ") for role in ("user", "assistant", "system")}
+
+
+def build_rag_prefix(system: str, retrieved_docs: list, preview_len: int = PREVIEW_LEN) -> str:
+    """
+    システム指示と検索結果ブロックからなるプロンプトの先頭部分を組み立てます。
+    検索結果が同じであればターンをまたいで同一の文字列になるため、
+    Ollama 側のプロンプトキャッシュ（KVキャッシュ）が再利用されます。
+    各断片は改行込みで並べ、最後に1回だけ連結します。
+    """
+    pieces = [system, "\n"] if system else []
+    if retrieved_docs:
+        if system:
+            pieces.append("\n")
+        pieces.append(_RAG_HEADER)
+        for i, doc in enumerate(retrieved_docs, 1):
+            # 読み込み時に切り出した preview があればそれを使い、毎ターンのスライスを避ける
+            preview = doc.get("preview") if preview_len == PREVIEW_LEN else None
+            if preview is None:
+                preview = doc['text'][:preview_len] # 長すぎないよう制限
+            pieces.extend(("講義", str(i), ": ", preview, "\n"))
+        pieces.append(_RAG_FOOTER)
+    return "".join(pieces)
+
+
+def build_prompt_with_rag(system: str, history: list, user_input: str, retrieved_docs: list, prefix: str = None, preview_len: int = PREVIEW_LEN) -> str:
+    """
+    既存のプロンプト形式を維持（先頭部分は build_rag_prefix で作成済みのものを渡せる）。
+    各講義のテキストは preview_len 文字で打ち切る。
+    """
+    if prefix is None:
+        prefix = build_rag_prefix(system, retrieved_docs, preview_len)
+    pieces = [prefix, "\n"] if prefix else []
+    
+    pieces.append(_HISTORY_HEADER)
+    for role, text in history:
+        label = _ROLE_LABELS.get(role)
+        if label is None:
+            label = f"{role.capitalize()}: "
+        pieces.extend((label, text, "\n"))
+    pieces.extend(("User: ", user_input, "\nAssistant:"))
+    return "".join(pieces)
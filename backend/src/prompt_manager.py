@@ -2,25 +2,39 @@
 Prompt management module.
 Loads templates from JSON files or uses hardcoded defaults for the Lecture RAG system.
 """
-from pathlib import Path
+from dataclasses import dataclass
+import functools
+import importlib.util
 import json
-from typing import Dict, List, Optional
+import logging
+import os
+import re
+import sys
+import textwrap
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Dict, List, Mapping, Optional, Tuple
 
-# LangChainのインポートエラー対策（最新バージョン対応）
-# try:
-from langchain_core.prompts import PromptTemplate
-LANGCHAIN_PROMPTS_AVAILABLE = True
-# except ImportError:
-#     PromptTemplate = None
-#     LANGCHAIN_PROMPTS_AVAILABLE = False
+logger = logging.getLogger(__name__)
 
+# orjson があればJSONの解析に使う（bytes をそのまま受け取れて標準の json より速い）
+try:
+    import orjson
+    _json_loads = orjson.loads
+    ORJSON_AVAILABLE = True
+except ImportError:
+    _json_loads = json.loads
+    ORJSON_AVAILABLE = False
 
-def get_default_template() -> Dict:
-    """
-    ファイルが見つからなかった場合に使う、講義RAG用のデフォルトテンプレート。
-    """
-    return {
-        "system_template": """
+# LangChain は import が重いので、PromptTemplate が必要になるまで読み込まない
+# （ここではインストールの有無だけを確認する）
+LANGCHAIN_PROMPTS_AVAILABLE = importlib.util.find_spec("langchain_core") is not None
+
+if TYPE_CHECKING:
+    from langchain_core.prompts import PromptTemplate
+
+
+# 講義RAG用のデフォルトテンプレート本文（ファイルが見つからなかった場合に使う）
+_DEFAULT_XML = sys.intern(textwrap.dedent("""
         <system_prompt>
             <role>あなたは同志社大学の履修アドバイザー「DUEC」です。学生が膨大なシラバスや履修要項から効率的に必要な情報を得られるよう支援してください。</role>
 
@@ -105,53 +119,174 @@ def get_default_template() -> Dict:
 
             <additional_instructions>{system_instruction}</additional_instructions>
         </system_prompt>
-        """,
-    "variables": ["system_instruction"]
-    }
+        """).strip())
+
+# variant 名 -> テンプレート。内容は固定なので import 時に一度だけ作り、読み取り専用で共有する
+_DEFAULT_TEMPLATES = {
+    "duec_xml": MappingProxyType({
+        "system_template": _DEFAULT_XML,
+        "variables": ("system_instruction",),
+    }),
+}
 
 
-def load_prompt_template(template_name: str, prompts_dir: str = "../prompts") -> Optional[Dict]:
+def get_default_template(variant: str = "duec_xml") -> Mapping:
+    """
+    ファイルが見つからなかった場合に使う、組み込みのデフォルトテンプレート。
+    """
+    return _DEFAULT_TEMPLATES[variant]
+
+
+def load_prompt_template(template_name: str, prompts_dir: str = "../prompts") -> Optional[Mapping]:
     """
     JSONファイルからプロンプトテンプレートを読み込む。
     ファイルがない場合は、'default'であればハードコードされたデフォルトを返す。
+    読み込み結果はキャッシュされる（ファイルを更新した場合は reload() を呼ぶ）。
+    キャッシュを共有するため、戻り値は読み取り専用の MappingProxyType。
     """
+    # 表記の異なる同じディレクトリ（相対パス・末尾スラッシュ等）が同じキャッシュに当たるよう正規化する。
+    # 相対パスはカレントディレクトリによって指す先が変わるので、その場合だけ cwd もキーに含める
+    cwd = "" if os.path.isabs(prompts_dir) else os.getcwd()
+    return _load_prompt_template_cached(template_name, _resolve_prompts_dir(prompts_dir, cwd))
+
+
+@functools.lru_cache(maxsize=8)
+def _resolve_prompts_dir(prompts_dir: str, cwd: str) -> str:
+    """prompts_dir を絶対パスに解決する（シンボリックリンクの解決を毎回行わないようキャッシュする）"""
+    return os.path.realpath(os.path.join(cwd, prompts_dir))
+
+
+@functools.lru_cache(maxsize=32)
+def _load_prompt_template_cached(template_name: str, prompts_dir: str) -> Optional[Mapping]:
     # 1. ファイルからの読み込みを試みる
-    path = Path(prompts_dir) / f"{template_name}.json"
-    if path.exists():
-        try:
-            with path.open("r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"Warning: Failed to load template {path}: {e}")
-            return None
+    path = os.path.join(prompts_dir, template_name + ".json")
+    try:
+        with open(path, "rb") as f:
+            data = _json_loads(f.read())
+        # 同じ内容のテンプレートは（別名のファイルや再読み込み後でも）同一の文字列オブジェクトを共有する
+        if isinstance(data.get("system_template"), str):
+            data["system_template"] = sys.intern(data["system_template"])
+        return MappingProxyType(data)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning("Failed to load template %s: %s", path, e)
+        return None
 
     # 2. ファイルがない場合、defaultなら内部定義を返す
     if template_name == "default":  
-        print("Using built-in default prompt template.")
+        logger.warning("Prompt file %s not found; using built-in default prompt template.", path)
         return get_default_template()
     
     return None
 
 
+# prompts_dir -> (ディレクトリの st_mtime_ns, テンプレート名一覧)
+_prompts_dir_cache: Dict[str, Tuple[int, List[str]]] = {}
+
+
 def list_available_prompts(prompts_dir: str = "../prompts") -> List[str]:
-    """利用可能なプロンプトテンプレートの一覧を返す"""
-    p = Path(prompts_dir)
+    """
+    利用可能なプロンプトテンプレートの一覧を返す。
+    ディレクトリの更新時刻が前回と同じなら、走査せずに前回の結果を返す。
+    """
+    try:
+        mtime = os.stat(prompts_dir).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+
+    cached = _prompts_dir_cache.get(prompts_dir)
+    if cached is not None and mtime is not None and cached[0] == mtime:
+        return list(cached[1])
+
     files = []
-    if p.exists():
-        files = [f.stem for f in p.glob("*.json")]
+    if mtime is not None:
+        with os.scandir(prompts_dir) as it:
+            files = [entry.name[:-5] for entry in it if entry.name.endswith(".json") and entry.is_file()]
     
     # defaultは常に使えるようにする
     if "default" not in files:
         files.insert(0, "default")
-    return files
+    if mtime is not None:
+        _prompts_dir_cache[prompts_dir] = (mtime, files)
+    return list(files)
 
 
-def render_prompt_template(template_dict: Dict, **kwargs) -> str:
+# {name} 形式の埋め込み変数と、エスケープされた波括弧 {{ }}
+_PLACEHOLDER_RE = re.compile(r"\{\{|\}\}|\{([A-Za-z_][A-Za-z0-9_]*)\}")
+
+
+@dataclass(frozen=True)
+class _CompiledTemplate:
+    """テンプレート文字列を固定部分と変数部分に分解したもの"""
+    segments: tuple        # 固定文字列。変数の位置には空文字が入る
+    var_indices: tuple     # (segments 内の位置, 変数名) の組
+    empty_rendering: str   # すべての変数が空文字のときの結果（変数がなければテンプレートそのもの）
+    required_names: frozenset  # 値が渡されないとテンプレートをそのまま返す変数（system_instruction 以外）
+
+    @property
+    def has_placeholders(self) -> bool:
+        return bool(self.var_indices)
+
+
+@functools.lru_cache(maxsize=64)
+def _compile_template(template_str: str) -> Optional[_CompiledTemplate]:
+    """
+    テンプレートを一度だけ解析して _CompiledTemplate にする（結果はキャッシュされる）。
+    {0} や書式指定など単純な {name} 以外の記法を含む場合は None を返し、str.format に任せる。
+    """
+    segments = []
+    var_indices = []
+    literal = []
+    pos = 0
+    for m in _PLACEHOLDER_RE.finditer(template_str):
+        chunk = template_str[pos:m.start()]
+        if "{" in chunk or "}" in chunk:
+            return None
+        literal.append(chunk)
+        pos = m.end()
+        name = m.group(1)
+        if name is None:
+            # {{ / }} は1文字の括弧として固定部分に含める
+            literal.append(m.group()[0])
+            continue
+        segments.append("".join(literal))
+        literal = []
+        var_indices.append((len(segments), name))
+        segments.append("")
+    chunk = template_str[pos:]
+    if "{" in chunk or "}" in chunk:
+        return None
+    literal.append(chunk)
+    segments.append("".join(literal))
+    required_names = frozenset(name for _, name in var_indices if name != "system_instruction")
+    return _CompiledTemplate(tuple(segments), tuple(var_indices), "".join(segments), required_names)
+
+
+def render_prompt_template(template_dict: Mapping, **kwargs) -> str:
     """テンプレートに変数を埋め込んで文字列にする"""
     if not template_dict:
         return ""
     
     template_str = template_dict.get("system_template", "")
+
+    # 解析済みのテンプレートがあれば、固定部分に値を差し込んで連結するだけで済む
+    # (str.format 版と同じく system_instruction だけは省略時に空文字とし、
+    #  それ以外の変数が足りない場合はテンプレートをそのまま返す)
+    compiled = _compile_template(template_str)
+    if compiled is not None:
+        if any(name not in kwargs for name in compiled.required_names):
+            return template_str
+        if not compiled.has_placeholders:
+            return compiled.empty_rendering
+        values = [kwargs.get(name, "") for _, name in compiled.var_indices]
+        # --system を指定しない通常の呼び出しでは埋め込む値がすべて空なので、作成済みの結果を返す
+        if all(v == "" for v in values):
+            return compiled.empty_rendering
+        parts = list(compiled.segments)
+        for (i, _), value in zip(compiled.var_indices, values):
+            parts[i] = str(value)
+        return "".join(parts)
     
     # テンプレート内の変数 {xxx} に対して、kwargsに値がなければ空文字を入れる安全策
     # (Pythonのformatは足りないとエラーになるため)
@@ -166,34 +301,54 @@ def render_prompt_template(template_dict: Dict, **kwargs) -> str:
         return template_str
 
 
-def get_langchain_prompt_template(template_dict: Dict) -> Optional[PromptTemplate]:
+@functools.lru_cache(maxsize=None)
+def _get_pt_class():
+    """初回呼び出し時に langchain_core の PromptTemplate を import して返す。使えなければ None"""
+    try:
+        from langchain_core.prompts import PromptTemplate
+    except ImportError:
+        return None
+    return PromptTemplate
+
+
+def get_langchain_prompt_template(template_dict: Mapping) -> Optional["PromptTemplate"]:
     """LangChainのPromptTemplateオブジェクトを作成して返す"""
     if not LANGCHAIN_PROMPTS_AVAILABLE or not template_dict:
         return None
+    if _get_pt_class() is None:
+        return None
     
     template_str = template_dict.get("system_template", "")
     input_variables = template_dict.get("variables", [])
     
     try:
-        return PromptTemplate(
-            input_variables=input_variables,
-            template=template_str
-        )
+        return _build_pt(template_str, tuple(input_variables))
     except Exception:
         return None
 
 
+@functools.lru_cache(maxsize=16)
+def _build_pt(template_str: str, input_variables: tuple) -> "PromptTemplate":
+    """同じテンプレートから毎回 PromptTemplate を作り直さない（検証コストを省く）"""
+    return _get_pt_class()(
+        input_variables=list(input_variables),
+        template=template_str
+    )
+
+
+@functools.lru_cache(maxsize=128)
 def format_system_instruction(template_name: str, system_input: str = "", prompts_dir: str = "/Users/toranosuke/Downloads/2025_M1_講義/M1秋/知識情報処理特論/duec/backend/prompts") -> str:
     """
     テンプレートを読み込み、ユーザー入力の追加指示(system_input)を埋め込んだ
     最終的なシステムプロンプト文字列を返す。
+    結果は引数のみで決まるため、同じ引数での2回目以降の呼び出しはキャッシュから返す。
     """
     # テンプレート読み込み
     template = load_prompt_template(template_name, prompts_dir)
     
     # テンプレートが見つからない場合のフォールバック
     if not template:
-        print(f"Warning: Prompt template '{template_name}' not found. Using default or raw input.")
+        logger.warning("Prompt template '%s' not found. Using default or raw input.", template_name)
         if template_name == "default":
              template = get_default_template()
         else:
@@ -206,4 +361,22 @@ def format_system_instruction(template_name: str, system_input: str = "", prompt
         "system_instruction": system_input
     }
     
-    return render_prompt_template(template, **kwargs)
\ No newline at end of file
+    return render_prompt_template(template, **kwargs)
+
+
+def clear_prompt_cache() -> None:
+    """読み込み済みテンプレートのキャッシュを破棄する"""
+    _load_prompt_template_cached.cache_clear()
+    _resolve_prompts_dir.cache_clear()
+    _compile_template.cache_clear()
+    _build_pt.cache_clear()
+
+
+def reload() -> None:
+    """
+    テンプレート関連のキャッシュをすべて破棄する。
+    prompts ディレクトリのJSONを編集・追加した後に呼ぶと、次回の呼び出しで読み直される。
+    """
+    clear_prompt_cache()
+    _prompts_dir_cache.clear()
+    format_system_instruction.cache_clear()
@@ -2,15 +2,34 @@ import json
 import os
 import re
 import csv
+import collections
+import functools
+import hashlib
+import pickle
+import threading
+import time
+from concurrent.futures import Future
 import numpy as np
 import torch
 from FlagEmbedding import BGEM3FlagModel
+# プロンプト組み立ては重い依存のない prompt_build に置き、ここでは互換のため再公開する
+from prompt_build import PREVIEW_LEN, build_rag_prefix, build_prompt_with_rag
 
-# 保存先ファイル名
-EMBEDDINGS_CACHE_PATH = "syllabus_embeddings.npy"
+# 埋め込みモデルとエンコード時の最大トークン長（キャッシュのキーにも含める）
+EMBEDDING_MODEL_NAME = 'BAAI/bge-m3'
+EMBEDDING_MAX_LENGTH = 512
+# 埋め込みキャッシュを置くディレクトリ
+EMBEDDINGS_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "duec")
 
 # デバイス設定
 device = "cuda" if torch.cuda.is_available() else "cpu"
+# float16 の行列を float32 に戻して類似度を計算するときの1ブロックの行数
+SCORE_BLOCK_ROWS = 4096
+# 類似度計算を GPU で行う最小の講義数（小さいDBでは転送の往復の方が計算より遅い）
+GPU_SIMILARITY_MIN_DOCS = 20000
+# BM25 で候補を絞ってから密ベクトルで再スコアする最小の講義数と、絞り込む候補数
+BM25_PREFILTER_MIN_DOCS = 20000
+BM25_SHORTLIST = 200
 # モデルの初期化を遅延させる: prepare_tfidf_index / retrieve_tfidf 実行時に初めてロードする
 _model = None
 
@@ -19,16 +38,18 @@ def get_model():
     global _model
     if _model is None:
         print("Initializing BGEM3FlagModel (this may take a long time and download weights)...")
-        _model = BGEM3FlagModel('BAAI/bge-m3', use_fp16=(device == "cuda"))
+        _model = BGEM3FlagModel(EMBEDDING_MODEL_NAME, use_fp16=(device == "cuda"))
     return _model
 
 # 外部ライブラリのインポート
+# orjson があればJSONの解析に使う（C実装で、bytes をそのまま受け取れる）
 try:
-    from sklearn.feature_extraction.text import TfidfVectorizer
-    from sklearn.metrics.pairwise import cosine_similarity
-    SKLEARN_AVAILABLE = True
+    import orjson
+    _json_loads = orjson.loads
+    ORJSON_AVAILABLE = True
 except ImportError:
-    SKLEARN_AVAILABLE = False
+    _json_loads = json.loads
+    ORJSON_AVAILABLE = False
 
 try:
     from rank_bm25 import BM25Okapi
@@ -36,14 +57,129 @@ try:
 except ImportError:
     BM25_AVAILABLE = False
 
+try:
+    import pandas as pd
+    PANDAS_AVAILABLE = True
+except ImportError:
+    PANDAS_AVAILABLE = False
+
+try:
+    import ahocorasick
+    AHOCORASICK_AVAILABLE = True
+except ImportError:
+    AHOCORASICK_AVAILABLE = False
+
+# 保存形式（L2正規化済み float16）。キャッシュのキーに含め、形式の違う古いキャッシュを読まないようにする
+_EMBEDDING_FORMAT = f"{EMBEDDING_MODEL_NAME}:{EMBEDDING_MAX_LENGTH}:l2-f16"
+
+def embeddings_cache_path(docs) -> str:
+    """
+    文書本文とモデル設定のハッシュから、埋め込みキャッシュのパスを返します。
+    内容で決まるため、DBファイルの移動や更新時刻だけの変化ではキャッシュが無効になりません。
+    """
+    h = hashlib.blake2b(digest_size=8)
+    h.update(_EMBEDDING_FORMAT.encode("utf-8"))
+    for doc in docs:
+        h.update(b"\0")
+        h.update(doc['text'].encode("utf-8"))
+    return os.path.join(EMBEDDINGS_CACHE_DIR, f"embeddings_{h.hexdigest()}.npy")
+
+def embeddings_store_path() -> str:
+    """講義ごとのベクトルを本文ハッシュで引けるように保存するファイルのパス（モデル設定ごと）"""
+    tag = hashlib.blake2b(_EMBEDDING_FORMAT.encode("utf-8"), digest_size=8).hexdigest()
+    return os.path.join(EMBEDDINGS_CACHE_DIR, f"embeddings_store_{tag}.npz")
+
+def doc_text_hash(doc) -> str:
+    return hashlib.blake2b(doc['text'].encode("utf-8"), digest_size=16).hexdigest()
+
+def professor_keys(prof_name: str) -> set:
+    """教授名から照合用のキー（空白を除いた氏名と、2文字以上の姓）を作ります"""
+    parts = prof_name.split()  # 全角スペースも区切りとして扱われる
+    keys = set()
+    full = "".join(parts)
+    if len(full) >= 2:
+        keys.add(full)
+    if len(parts) > 1 and len(parts[0]) >= 2:
+        keys.add(parts[0])
+    return keys
+
+def build_professor_matcher(keys):
+    """
+    教授名キーの集合から、文中の教授名をまとめて見つける照合器を作ります。
+    pyahocorasick があれば Aho-Corasick オートマトン、なければ1本の正規表現にします。
+    """
+    keys = sorted(set(keys), key=len, reverse=True)
+    if not keys:
+        return None
+    if AHOCORASICK_AVAILABLE:
+        automaton = ahocorasick.Automaton()
+        for key in keys:
+            automaton.add_word(key, key)
+        automaton.make_automaton()
+        return automaton
+    return re.compile("|".join(map(re.escape, keys)))
+
+def match_professors(matcher, text: str) -> set:
+    """text に含まれる教授名キーの集合を返します"""
+    if matcher is None:
+        return set()
+    if AHOCORASICK_AVAILABLE:
+        # オートマトンは重なった一致（「佐藤健哉」の中の「佐藤」など）も返すので、
+        # 正規表現版と同じく左から順に、同じ位置では最長の一致だけを重ならないように選ぶ
+        spans = sorted(((end - len(key) + 1, -len(key), key) for end, key in matcher.iter(text)))
+        found = set()
+        pos = 0
+        for start, neg_len, key in spans:
+            if start >= pos:
+                found.add(key)
+                pos = start - neg_len
+        return found
+    return set(matcher.findall(text))
+
+# 記号を除去し、意味のある文字列の塊（英数字・漢字・ひらがな・カタカナ）を抽出する
+_TOKEN_RE = re.compile(r'[A-Za-z0-9]+|[㐀-䶵一-龠々]+|[ぁ-ん]+|[ァ-ヶー]+')
+# 「〇〇教授」の形の教授名（DBにない名前で除外するときに使う）
+_PROF_SUFFIX_RE = re.compile(r'([一-龠]{2,4})教授')
+
 def simple_tokenize(text):
     """
     日本語の簡易トークナイザー。
     正規表現を用いて、漢字、ひらがな、カタカナ、英数字の塊を抽出します。
     """
-    # 記号を除去し、意味のある文字列の塊を抽出
-    tokens = re.findall(r'[A-Za-z0-9]+|[㐀-䶵一-龠々]+|[ぁ-ん]+|[ァ-ヶー]+', text)
-    return tokens
+    return _TOKEN_RE.findall(text)
+
+def _read_csv_rows(db_path: str) -> list:
+    """
+    CSVを読み込み、カラム名と値の前後の空白を除いた行の辞書のリストを返します。
+    pandas があればC実装のパーサーと列単位の処理で読み込み、なければ csv.DictReader を使います。
+    列数の合わない行があって pandas が読めない場合も csv.DictReader で読み直します。
+    """
+    if PANDAS_AVAILABLE:
+        try:
+            # utf-8-sig を使うことでBOM(Byte Order Mark)を自動で除去します
+            df = pd.read_csv(db_path, dtype=str, keep_default_na=False,
+                             encoding='utf-8-sig', encoding_errors='replace')
+        except ValueError as e:  # pd.errors.ParserError（"Expected N fields ..."）を含む
+            print(f"Warning: pandas could not parse {db_path} ({str(e).strip()}); falling back to csv.DictReader.")
+        else:
+            df.columns = df.columns.str.strip()
+            # 名前のないカラムは csv.DictReader 版と同様に捨てる
+            df = df.loc[:, ~df.columns.str.startswith("Unnamed:")]
+            # 列の足りない行の欠損は csv.DictReader 版と同様に空文字にする
+            df = df.fillna("").apply(lambda col: col.str.strip())
+            return df.to_dict(orient='records')
+
+    # utf-8-sig を使うことでBOM(Byte Order Mark)を自動で除去します
+    with open(db_path, 'r', encoding='utf-8-sig', errors='replace') as f:
+        # csv.DictReaderを使用して辞書形式で読み込む
+        reader = csv.DictReader(f)
+
+        # ヘッダー（カラム名）から前後の空白を削除して正規化
+        if reader.fieldnames:
+            reader.fieldnames = [name.strip() for name in reader.fieldnames]
+
+        # 行データの前後の空白を削除
+        return [{k: (v.strip() if v else "") for k, v in row.items() if k} for row in reader]
 
 def load_course_db_from_csv(db_path: str):
     """
@@ -55,113 +191,110 @@ def load_course_db_from_csv(db_path: str):
         return None
     
     try:
-        # utf-8-sig を使うことでBOM(Byte Order Mark)を自動で除去します
-        with open(db_path, 'r', encoding='utf-8-sig', errors='replace') as f:
-            # csv.DictReaderを使用して辞書形式で読み込む
-            reader = csv.DictReader(f)
+        # 行データ（カラム名・値の前後の空白は除去済み）を読み込む
+        rows = _read_csv_rows(db_path)
+
+        processed_data = []
+        known_professors = set()
+
+        for item in rows:
+            # 「科目名」がない行はスキップ
+            if not item.get("科目名"):
+                continue
+
+            # --- メタデータの収集 ---
+            prof_name = item.get("教授名", "").strip()
+            if prof_name:
+                known_professors.add(prof_name)
+                # 検索揺らぎ対応（スペース除去）
+                known_professors.add(prof_name.replace(" ", "").replace("　", ""))
+
+            # --- テキスト構築 (RAG検索対象) ---
+            title = item.get("科目名", "名称不明")
+            # 1行ごとに f-string を作らず、断片と改行をそのまま並べて最後に1回だけ連結する
+            text_parts = []
             
-            # ヘッダー（カラム名）から前後の空白を削除して正規化
-            if reader.fieldnames:
-                reader.fieldnames = [name.strip() for name in reader.fieldnames]
+            text_parts.extend(("【科目名】 ", str(title), "\n"))
+            if item.get("学科"):
+                text_parts.extend(("【学科】 ", item['学科'], "\n"))
+            if prof_name:
+                text_parts.extend(("【担当教授】 ", prof_name, "\n"))
             
-            processed_data = []
-            known_professors = set()
-
-            for row in reader:
-                # 行データの前後の空白を削除
-                item = {k: (v.strip() if v else "") for k, v in row.items() if k}
-                
-                # 「科目名」がない行はスキップ
-                if not item.get("科目名"):
-                    continue
-
-                # --- メタデータの収集 ---
-                prof_name = item.get("教授名", "").strip()
-                if prof_name:
-                    known_professors.add(prof_name)
-                    # 検索揺らぎ対応（スペース除去）
-                    known_professors.add(prof_name.replace(" ", "").replace("　", ""))
-
-                # --- テキスト構築 (RAG検索対象) ---
-                title = item.get("科目名", "名称不明")
-                text_parts = []
-                
-                text_parts.append(f"【科目名】 {title}")
-                if item.get("学科"):
-                    text_parts.append(f"【学科】 {item['学科']}")
-                if prof_name:
-                    text_parts.append(f"【担当教授】 {prof_name}")
-                
-                basic_info = []
-                if item.get("開講学期"): basic_info.append(item['開講学期'])
-                if item.get("曜日・時限"): basic_info.append(item['曜日・時限'])
-                if item.get("単位数"): basic_info.append(f"{item['単位数']}単位")
-                if item.get("授業形態"): basic_info.append(item['授業形態'])
-                if basic_info:
-                    text_parts.append(f"【基本情報】 {' / '.join(basic_info)}")
-                
-                if item.get("概要"):
-                    text_parts.append(f"【概要】\n{item['概要']}")
-                if item.get("到達目標"):
-                    text_parts.append(f"【到達目標】\n{item['到達目標']}")
-
-                # 授業計画の処理（JSON文字列であればパースして箇条書きにする）
-                plan_raw = item.get("授業計画", "")
-                if plan_raw and plan_raw.startswith("["):
-                    try:
-                        plans = json.loads(plan_raw)
-                        text_parts.append("【授業計画】")
-                        for plan in plans:
-                            text_parts.append(f"  第{plan.get('授業回', '?')}回: {plan.get('内容', '')}")
-                    except:
-                        text_parts.append(f"【授業計画】\n{plan_raw}")
-                elif plan_raw:
-                    text_parts.append(f"【授業計画】\n{plan_raw}")
-
-                # 成績評価基準の処理
-                eval_raw = item.get("成績評価基準", "")
-                if eval_raw and eval_raw.startswith("["):
-                    try:
-                        evals = json.loads(eval_raw)
-                        text_parts.append("【成績評価基準】")
-                        for crit in evals:
-                            text_parts.append(f"  - {crit.get('項目', '')} ({crit.get('割合', '')}): {crit.get('詳細', '')}")
-                    except:
-                        text_parts.append(f"【成績評価基準】\n{eval_raw}")
-                elif eval_raw:
-                    text_parts.append(f"【成績評価基準】\n{eval_raw}")
-
-                # 成績評価結果の処理 (成績分布など)
-                res_raw = item.get("成績評価結果", "")
-                if res_raw and res_raw.startswith("{"):
-                    try:
-                        res = json.loads(res_raw)
-                        res_summary = ", ".join([f"{k}: {v}" for k, v in res.items()])
-                        text_parts.append(f"【成績実績】 {res_summary}")
-                    except:
-                        pass
-
-                combined_text = "\n".join(text_parts)
-
-                processed_data.append({
-                    "title": title,
-                    "professor": prof_name,
-                    "semester": item.get("開講学期", ""),
-                    "text": combined_text,
-                    "period": item.get("曜日・時限", ""),
-                    "raw": item
-                })
-
-            if len(processed_data) == 0:
-                print("Error: No valid course data found in CSV. Check column names or encoding.")
-                return None
+            basic_info = []
+            if item.get("開講学期"): basic_info.append(item['開講学期'])
+            if item.get("曜日・時限"): basic_info.append(item['曜日・時限'])
+            if item.get("単位数"): basic_info.append(f"{item['単位数']}単位")
+            if item.get("授業形態"): basic_info.append(item['授業形態'])
+            if basic_info:
+                text_parts.extend(("【基本情報】 ", " / ".join(basic_info), "\n"))
             
-            return {
-                "docs": processed_data,
-                "metadata": {
-                    "professors": list(known_professors)
-                }
-            }
+            if item.get("概要"):
+                text_parts.extend(("【概要】\n", str(item['概要']), "\n"))
+            if item.get("到達目標"):
+                text_parts.extend(("【到達目標】\n", str(item['到達目標']), "\n"))
+
+            # 授業計画の処理（JSON文字列であればパースして箇条書きにする）
+            plan_raw = item.get("授業計画", "")
+            if plan_raw and plan_raw.startswith("["):
+                try:
+                    plans = _json_loads(plan_raw)
+                    text_parts.extend(("【授業計画】", "\n"))
+                    for plan in plans:
+                        text_parts.extend(("  第", str(plan.get('授業回', '?')), "回: ", str(plan.get('内容', '')), "\n"))
+                except:
+                    text_parts.extend(("【授業計画】\n", plan_raw, "\n"))
+            elif plan_raw:
+                text_parts.extend(("【授業計画】\n", plan_raw, "\n"))
+
+            # 成績評価基準の処理
+            eval_raw = item.get("成績評価基準", "")
+            if eval_raw and eval_raw.startswith("["):
+                try:
+                    evals = _json_loads(eval_raw)
+                    text_parts.extend(("【成績評価基準】", "\n"))
+                    for crit in evals:
+                        text_parts.extend(("  - ", str(crit.get('項目', '')), " (", str(crit.get('割合', '')), "): ", str(crit.get('詳細', '')), "\n"))
+                except:
+                    text_parts.extend(("【成績評価基準】\n", eval_raw, "\n"))
+            elif eval_raw:
+                text_parts.extend(("【成績評価基準】\n", eval_raw, "\n"))
+
+            # 成績評価結果の処理 (成績分布など)
+            res_raw = item.get("成績評価結果", "")
+            if res_raw and res_raw.startswith("{"):
+                try:
+                    res = _json_loads(res_raw)
+                    res_summary = ", ".join([f"{k}: {v}" for k, v in res.items()])
+                    text_parts.extend(("【成績実績】 ", res_summary, "\n"))
+                except:
+                    pass
+
+            text_parts.pop()  # 最後の行の後ろの改行は付けない（改行は常に単独の要素として追加している）
+            combined_text = "".join(text_parts)
+
+            processed_data.append({
+                "title": title,
+                "professor": prof_name,
+                "semester": item.get("開講学期", ""),
+                "text": combined_text,
+                "preview": combined_text[:PREVIEW_LEN],
+                "period": item.get("曜日・時限", ""),
+                # キーワード検索（retrieve）用に小文字化した本文
+                "lower_text": combined_text.lower(),
+                "raw": item
+            })
+
+        if len(processed_data) == 0:
+            print("Error: No valid course data found in CSV. Check column names or encoding.")
+            return None
+        
+        return {
+            "docs": processed_data,
+            "metadata": {
+                "professors": list(known_professors)
+            },
+            "source": db_path
+        }
 
     except Exception as e:
         print(f"Error loading CSV: {e}")
@@ -177,8 +310,8 @@ def load_course_db(db_path: str):
         return None
     
     try:
-        with open(db_path, 'r', encoding='utf-8') as f:
-            raw_data = json.load(f)
+        with open(db_path, 'rb') as f:
+            raw_data = _json_loads(f.read())
             
             if not isinstance(raw_data, list):
                 print("Error: JSON root must be a list.")
@@ -202,42 +335,47 @@ def load_course_db(db_path: str):
 
                 # --- テキスト構築 (既存ロジック維持) ---
                 title = item.get("科目名", "名称不明")
+                # 1行ごとに f-string を作らず、断片と改行をそのまま並べて最後に1回だけ連結する
                 text_parts = []
                 
-                text_parts.append(f"【科目名】 {title}")
+                text_parts.extend(("【科目名】 ", str(title), "\n"))
                 if "教授名" in item:
-                    text_parts.append(f"【担当教授】 {item['教授名']}")
+                    text_parts.extend(("【担当教授】 ", str(item['教授名']), "\n"))
                 if "開講学期" in item:
-                    text_parts.append(f"【開講】 {item['開講学期']} {item.get('曜日・時限', '')}")
+                    text_parts.extend(("【開講】 ", str(item['開講学期']), " ", str(item.get('曜日・時限', '')), "\n"))
                 
                 if "概要" in item:
-                    text_parts.append(f"【概要】\n{item['概要']}")
+                    text_parts.extend(("【概要】\n", str(item['概要']), "\n"))
                 if "到達目標" in item:
-                    text_parts.append(f"【到達目標】\n{item['到達目標']}")
+                    text_parts.extend(("【到達目標】\n", str(item['到達目標']), "\n"))
 
                 if "授業計画" in item and isinstance(item["授業計画"], list):
-                    text_parts.append("【授業計画】")
+                    text_parts.extend(("【授業計画】", "\n"))
                     for plan in item["授業計画"]:
                         kai = plan.get("授業回", "")
                         naiyou = plan.get("内容", "")
-                        text_parts.append(f"  第{kai}回: {naiyou}")
+                        text_parts.extend(("  第", str(kai), "回: ", str(naiyou), "\n"))
 
                 if "成績評価基準" in item and isinstance(item["成績評価基準"], list):
-                    text_parts.append("【成績評価基準】")
+                    text_parts.extend(("【成績評価基準】", "\n"))
                     for crit in item["成績評価基準"]:
                         komoku = crit.get("項目", "")
                         wariai = crit.get("割合", "")
                         shosai = crit.get("詳細", "")
-                        text_parts.append(f"  - {komoku} ({wariai}): {shosai}")
+                        text_parts.extend(("  - ", str(komoku), " (", str(wariai), "): ", str(shosai), "\n"))
 
-                combined_text = "\n".join(text_parts)
+                text_parts.pop()  # 最後の行の後ろの改行は付けない（改行は常に単独の要素として追加している）
+                combined_text = "".join(text_parts)
 
                 processed_data.append({
                     "title": title,
                     "professor": prof_name, # フィルタリング用に保持
                     "semester": item.get("開講学期", ""),
                     "text": combined_text,
+                    "preview": combined_text[:PREVIEW_LEN],
                     "period": item.get("曜日・時限", ""),
+                    # キーワード検索（retrieve）用に小文字化した本文
+                    "lower_text": combined_text.lower(),
                     "raw": item
                 })
 
@@ -250,7 +388,8 @@ def load_course_db(db_path: str):
                 "docs": processed_data,
                 "metadata": {
                     "professors": list(known_professors)
-                }
+                },
+                "source": db_path
             }
 
     except Exception as e:
@@ -260,99 +399,471 @@ def load_course_db(db_path: str):
 def prepare_tfidf_index(db_wrapper):
     """
     埋め込みベクトルを作成、またはキャッシュから読み込みます。
+    キャッシュは文書本文のハッシュをキーにして EMBEDDINGS_CACHE_DIR に保存するため、
+    講義の内容が変わらない限り2回目以降の起動ではエンコードを行いません。
     """
     if not db_wrapper or "docs" not in db_wrapper: return None
 
     docs = db_wrapper["docs"]
+    cache_path = embeddings_cache_path(docs)
     
     # --- キャッシュの確認 ---
-    if os.path.exists(EMBEDDINGS_CACHE_PATH):
-        print(f"キャッシュファイル {EMBEDDINGS_CACHE_PATH} を読み込んでいます...")
-        embeddings = np.load(EMBEDDINGS_CACHE_PATH)
+    if os.path.exists(cache_path):
+        print(f"キャッシュファイル {cache_path} を読み込んでいます...")
+        # メモリマップで開き、起動時に行列全体をメモリへ読み込まない
+        embeddings = np.load(cache_path, mmap_mode='r')
         
         # 件数が一致するか念のためチェック
         if len(embeddings) == len(docs):
             print("キャッシュからの読み込みに成功しました。")
-            return {"embeddings": embeddings, "docs": docs}
+            return _build_index(embeddings, docs, cache_hit=True, bm25=_load_bm25(docs, cache_path))
         else:
             print("CSVとキャッシュの件数が一致しません。再作成します。")
 
-    # --- キャッシュがない、または古い場合は新規作成 ---
-    corpus_texts = [doc['text'] for doc in docs]
-    print(f"BGE-M3を使用して新規インデックスを作成中... (対象: {len(corpus_texts)}件)")
+    # --- キャッシュがない、または古い場合は新規作成（エンコードするのは新規・変更された講義だけ） ---
+    embeddings = _encode_docs_incremental(docs)
     
-    # ベクトル化の実行（モデルは遅延初期化）
-    embeddings = get_model().encode(corpus_texts, batch_size=12, max_length=512)['dense_vecs']
-    
-    # ベクトルを保存
-    np.save(EMBEDDINGS_CACHE_PATH, embeddings)
-    print(f"埋め込みベクトルを {EMBEDDINGS_CACHE_PATH} に保存しました。")
-    
-    return {
+    # ベクトルを保存（L2正規化済みの float16）
+    os.makedirs(EMBEDDINGS_CACHE_DIR, exist_ok=True)
+    np.save(cache_path, embeddings)
+    print(f"埋め込みベクトルを {cache_path} に保存しました。")
+
+    bm25 = _load_bm25(docs, cache_path)
+    _prune_stale_caches(cache_path)
+    return _build_index(embeddings, docs, cache_hit=False, bm25=bm25)
+
+def _prune_stale_caches(cache_path: str):
+    """
+    保存に成功した cache_path 以外の埋め込みキャッシュ（embeddings_<ハッシュ>.npy）と
+    BM25 キャッシュ（.bm25.pkl）を削除し、DB を編集するたびにキャッシュが溜まり続けないようにします。
+    """
+    stem = os.path.splitext(os.path.basename(cache_path))[0]
+    cache_dir = os.path.dirname(cache_path)
+    for name in os.listdir(cache_dir):
+        if not name.startswith("embeddings_") or name.startswith("embeddings_store_"):
+            continue
+        if name.endswith(".bm25.pkl"):
+            name_stem = name[:-len(".bm25.pkl")]
+        elif name.endswith(".npy"):
+            name_stem = name[:-len(".npy")]
+        else:
+            continue
+        if name_stem != stem:
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError as e:
+                print(f"Warning: failed to remove stale cache {name}: {e}")
+
+def _load_bm25(docs, cache_path: str):
+    """
+    大きなDB向けに、候補の絞り込みに使う BM25 索引を作成、またはキャッシュから読み込みます。
+    rank_bm25 がない場合や講義数が BM25_PREFILTER_MIN_DOCS 未満の場合は None を返します。
+    """
+    if not BM25_AVAILABLE or len(docs) < BM25_PREFILTER_MIN_DOCS:
+        return None
+    bm25_path = os.path.splitext(cache_path)[0] + ".bm25.pkl"
+    if os.path.exists(bm25_path):
+        try:
+            with open(bm25_path, "rb") as f:
+                bm25 = pickle.load(f)
+            if bm25.corpus_size == len(docs):
+                return bm25
+        except Exception as e:
+            print(f"Warning: failed to load BM25 cache {bm25_path}: {e}")
+    bm25 = BM25Okapi([[t.lower() for t in simple_tokenize(doc['text'])] for doc in docs])
+    try:
+        with open(bm25_path, "wb") as f:
+            pickle.dump(bm25, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError as e:
+        print(f"Warning: failed to write BM25 cache {bm25_path}: {e}")
+    return bm25
+
+def _bm25_shortlist(bm25, query: str):
+    """BM25 スコア上位 BM25_SHORTLIST 件の番号（昇順）。質問に一致する語がなければ None"""
+    terms = [t.lower() for t in simple_tokenize(query)]
+    if not terms:
+        return None
+    scores = bm25.get_scores(terms)
+    if not scores.any():
+        return None
+    if BM25_SHORTLIST < scores.size:
+        return np.sort(np.argpartition(-scores, BM25_SHORTLIST)[:BM25_SHORTLIST])
+    return None
+
+def _encode_docs_incremental(docs):
+    """
+    講義のベクトル行列（L2正規化済み float16）を docs の順に並べて返します。
+    embeddings_store_path() に本文ハッシュ -> ベクトルを保存しておき、
+    講義の追加・変更時には保存にない講義だけをエンコードします。
+    """
+    store_path = embeddings_store_path()
+    hashes = [doc_text_hash(doc) for doc in docs]
+    vec_by_hash = {}
+    if os.path.exists(store_path):
+        try:
+            with np.load(store_path) as store:
+                vec_by_hash = dict(zip(store["hashes"].tolist(), store["vecs"]))
+        except Exception as e:
+            print(f"Warning: failed to load embedding store {store_path}: {e}")
+
+    # 同じ本文の講義は1回だけエンコードする
+    missing = {}
+    for doc, h in zip(docs, hashes):
+        if h not in vec_by_hash:
+            missing.setdefault(h, doc['text'])
+    if missing:
+        print(f"BGE-M3を使用して新規インデックスを作成中... (対象: {len(missing)}件 / 全{len(docs)}件)")
+        # ベクトル化の実行（モデルは遅延初期化）
+        with torch.inference_mode():
+            new_vecs = get_model().encode(list(missing.values()), batch_size=12, max_length=EMBEDDING_MAX_LENGTH)['dense_vecs']
+        # 正規化は保存前に一度だけ行い、次回以降の起動では読み込むだけにする。
+        # 正規化済みの値は float16 で十分な精度があり、検索時に読む量が半分になる
+        vec_by_hash.update(zip(missing, normalize_rows(new_vecs).astype(np.float16)))
+    else:
+        print("保存済みのベクトルから埋め込み行列を組み立てます。")
+
+    # 保存するのは現在の講義のベクトルだけにする（削除・変更された講義の古いベクトルは捨てる）
+    current = dict.fromkeys(hashes)
+    if missing or len(vec_by_hash) != len(current):
+        os.makedirs(EMBEDDINGS_CACHE_DIR, exist_ok=True)
+        np.savez(store_path, hashes=np.array(list(current), dtype="U32"), vecs=np.stack([vec_by_hash[h] for h in current]))
+    return np.stack([vec_by_hash[h] for h in hashes])
+
+def normalize_rows(embeddings):
+    """
+    各行を L2 正規化した float32 の行列を返します。
+    GPU で fp16 エンコードした場合でも、CPU での行列演算が速い float32 にそろえます。
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    return embeddings / (np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-12)
+
+def _build_index(embeddings, docs, cache_hit: bool, bm25=None):
+    """
+    検索用のインデックス辞書を作ります。
+    embeddings は normalize_rows 済み（キャッシュには float16 で保存）なので、
+    検索時のコサイン類似度は内積1回で求まります。
+    """
+    # 教授名キー -> 担当講義の番号（否定条件の除外を全件走査せずに行うため）
+    prof_to_docs = {}
+    for i, doc in enumerate(docs):
+        for key in professor_keys(doc['professor']):
+            prof_to_docs.setdefault(key, []).append(i)
+    # 大きなDBで GPU が使える場合は、正規化済み行列を一度だけ GPU に転送しておく
+    embeddings_gpu = None
+    if device == "cuda" and len(docs) >= GPU_SIMILARITY_MIN_DOCS:
+        embeddings_gpu = torch.from_numpy(np.array(embeddings)).to(device)
+    index_data = {
         "embeddings": embeddings,
-        "docs": docs
+        "embeddings_gpu": embeddings_gpu,
+        "docs": docs,
+        "professor_matcher": build_professor_matcher(prof_to_docs),
+        "prof_to_docs": prof_to_docs,
+        # 空白を除いた教授名の配列（DBにない名前で除外するときの部分一致をまとめて行う）
+        "professors_norm": np.array(["".join(doc['professor'].split()) for doc in docs], dtype=str),
+        # 講義 x 時限キーワードの一致表（時限ブーストを行列演算1回で求めるため）
+        "period_bits": period_bits(docs),
+        # 大きなDBでの候補絞り込み用（小さいDBでは None で、全件を密ベクトルで比較する）
+        "bm25": bm25,
+        "cache_hit": cache_hit
     }
+    # 検索結果キャッシュは最新のインデックスだけを対象にする（作り直したら古い結果は破棄）
+    _INDEX_BY_ID.clear()
+    _INDEX_BY_ID[id(index_data)] = index_data
+    _retrieve_tfidf_cached.cache_clear()
+    return index_data
+
+# マイクロバッチ: 1回の encode にまとめる最大件数と、後続の質問を待つ最大時間
+QUERY_BATCH_MAX = 32
+QUERY_BATCH_WAIT_MS = 5
+
+class _QueryBatcher:
+    """
+    別スレッドから同時に届いた質問を短時間ためて、1回の encode にまとめるワーカー。
+    最初の質問が届いてから QUERY_BATCH_WAIT_MS だけ（最大 QUERY_BATCH_MAX 件まで）待ち、
+    まとめてベクトル化した結果を各呼び出し元の Future に返します。
+    """
+    def __init__(self, max_batch: int = QUERY_BATCH_MAX, max_wait_ms: float = QUERY_BATCH_WAIT_MS):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._pending = []  # list of (query, Future)
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="query-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, query: str) -> Future:
+        future = Future()
+        with self._cond:
+            self._pending.append((query, future))
+            self._cond.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                deadline = time.monotonic() + self.max_wait
+                while len(self._pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+            try:
+                vecs = _encode_queries_direct([q for q, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), vec in zip(batch, vecs):
+                future.set_result(vec)
+
+# enable_query_batching() を呼んだ場合だけ使う（CLI のような単発利用では待ち時間が無駄になる）。
+# ワーカースレッドは最初の encode_queries で、そのプロセス内に作る
+_query_batching = None  # (max_batch, max_wait_ms)
+_query_batcher = None
+_query_batcher_pid = None
+_query_batcher_lock = threading.Lock()
+
+def enable_query_batching(max_batch: int = QUERY_BATCH_MAX, max_wait_ms: float = QUERY_BATCH_WAIT_MS):
+    """
+    複数スレッドから並行して検索するサーバー向けに、質問のマイクロバッチ化を有効にします。
+    以降の encode_queries / encode_query はワーカー経由でまとめてベクトル化されます。
+    ここでは設定するだけで、スレッドは起動しません（import 時に呼んでも副作用がない）。
+    """
+    global _query_batching
+    _query_batching = (max_batch, max_wait_ms)
+
+def _get_query_batcher():
+    """
+    有効なら現在のプロセスのバッチ化ワーカーを返します（なければ作る）。無効なら None。
+    gunicorn --preload などでフォークされた場合、親のスレッドは子に引き継がれないので作り直します。
+    """
+    global _query_batcher, _query_batcher_pid
+    if _query_batching is None:
+        return None
+    with _query_batcher_lock:
+        if _query_batcher is None or _query_batcher_pid != os.getpid():
+            _query_batcher = _QueryBatcher(*_query_batching)
+            _query_batcher_pid = os.getpid()
+        return _query_batcher
+
+def _encode_queries_direct(queries):
+    # 推論のみなので autograd の記録を完全に止める（grad モードはスレッドごとなので呼び出しごとに指定）
+    with torch.inference_mode():
+        return np.asarray(get_model().encode(list(queries), batch_size=QUERY_BATCH_MAX)['dense_vecs'])
+
+# 質問文 -> 密ベクトルの LRU キャッシュ（再送や同じ質問の繰り返しでモデルを呼ばない）
+QUERY_EMB_CACHE_SIZE = 10000
+_QUERY_EMB_CACHE = collections.OrderedDict()
+_QUERY_EMB_LOCK = threading.Lock()
+
+def encode_queries(queries):
+    """
+    複数の質問文をまとめて BGE-M3 の密ベクトル（行列）に変換します。
+    キャッシュにない質問だけをベクトル化します。
+    """
+    queries = list(queries)
+    vecs = [None] * len(queries)
+    with _QUERY_EMB_LOCK:
+        for i, q in enumerate(queries):
+            vec = _QUERY_EMB_CACHE.get(q)
+            if vec is not None:
+                _QUERY_EMB_CACHE.move_to_end(q)
+                vecs[i] = vec
+    missing = [i for i, vec in enumerate(vecs) if vec is None]
+    if missing:
+        texts = list(dict.fromkeys(queries[i] for i in missing))
+        batcher = _get_query_batcher()
+        if batcher is None:
+            encoded = _encode_queries_direct(texts)
+        else:
+            encoded = [f.result() for f in [batcher.submit(q) for q in texts]]
+        # 各ベクトルはバッチ出力の行（ビュー）なので、コピーして保存し、
+        # キャッシュに残った1行がバッチ全体の配列を保持し続けないようにする
+        new_vecs = {q: np.array(vec, copy=True) for q, vec in zip(texts, encoded)}
+        with _QUERY_EMB_LOCK:
+            for q, vec in new_vecs.items():
+                _QUERY_EMB_CACHE[q] = vec
+                _QUERY_EMB_CACHE.move_to_end(q)
+            while len(_QUERY_EMB_CACHE) > QUERY_EMB_CACHE_SIZE:
+                _QUERY_EMB_CACHE.popitem(last=False)
+        for i in missing:
+            vecs[i] = new_vecs[queries[i]]
+    return np.stack(vecs)
+
+def encode_query(query: str):
+    """質問文を BGE-M3 の密ベクトルに変換します"""
+    return encode_queries([query])[0]
+
+# 加点対象の時限キーワード（先頭の数字が講義の「曜日・時限」に含まれていれば一致とみなす）
+TIME_KEYWORDS = ("1限", "１限", "2限", "２限", "3限", "３限", "4限", "４限", "5限", "５限")
+# 質問の時限キーワード1つにつき、一致した講義に加えるスコア
+TIME_BOOST = 0.1
+
+def period_bits(docs) -> np.ndarray:
+    """(講義数, len(TIME_KEYWORDS)) の float32 行列。列 j は TIME_KEYWORDS[j] の数字が時限に含まれるか"""
+    chars = [tk[0] for tk in TIME_KEYWORDS]
+    # 「曜日・時限」列のない講義（外部から渡された docs など）は一致なしとして扱う
+    periods = [doc.get('period') or "" for doc in docs]
+    bits = np.array([[ch in period for ch in chars] for period in periods], dtype=np.float32)
+    return bits.reshape(len(docs), len(chars))
+
+# id(index_data) -> 最後に作ったインデックス。検索結果キャッシュのキーに使う
+_INDEX_BY_ID = {}
 
 def retrieve_tfidf(query: str, index_data, k: int = 3):
     """
     ハイブリッド検索ロジック (BGE-M3ベクトル検索 + 条件フィルタ)
+    最新のインデックスに対する同じ質問の結果はキャッシュから返します。
     """
     if not index_data: return []
+    if _INDEX_BY_ID.get(id(index_data)) is index_data:
+        return list(_retrieve_tfidf_cached(query, k, id(index_data)))
+    return retrieve_tfidf_batch([query], index_data, k)[0]
+
+@functools.lru_cache(maxsize=256)
+def _retrieve_tfidf_cached(query: str, k: int, index_id: int) -> tuple:
+    return tuple(retrieve_tfidf_batch([query], _INDEX_BY_ID[index_id], k)[0])
+
+def retrieve_tfidf_batch(queries: list, index_data, k: int = 3) -> list:
+    """
+    複数の質問をまとめて検索し、質問ごとの検索結果のリストを返します。
+    質問のベクトル化と類似度計算はそれぞれ1回の呼び出し・行列演算で行います。
+    """
+    if not index_data: return [[] for _ in queries]
+    if not queries: return []
 
-    docs = index_data["docs"]
     embeddings = index_data["embeddings"]
 
     # 1. ユーザーの質問をベクトル化（モデルは遅延初期化）
-    query_result = get_model().encode([query])['dense_vecs']
-    query_vec = query_result[0]
-    
-    # 2. コサイン類似度の計算
-    scores = np.dot(embeddings, query_vec) / (np.linalg.norm(embeddings, axis=1) * np.linalg.norm(query_vec))
-    
+    query_vecs = encode_queries(queries)
+
+    # 2. コサイン類似度の計算（文書側はインデックス作成時に正規化済みなので、クエリだけ正規化する）
+    query_vecs = np.asarray(query_vecs, dtype=np.float32)
+    query_vecs = query_vecs / (np.linalg.norm(query_vecs, axis=1, keepdims=True) + 1e-12)
+    bm25 = index_data.get("bm25")
+    embeddings_gpu = index_data.get("embeddings_gpu")
+    if bm25 is not None:
+        # 2段階検索: BM25 で絞った候補だけ内積を計算し、それ以外は候補外（-inf）とする
+        all_scores = np.full((len(queries), embeddings.shape[0]), -np.inf, dtype=np.float32)
+        for row, (query, q) in enumerate(zip(queries, query_vecs)):
+            shortlist = _bm25_shortlist(bm25, query)
+            if shortlist is None:
+                all_scores[row] = _similarity(embeddings, q[None, :])[0]
+            else:
+                all_scores[row, shortlist] = np.asarray(embeddings[shortlist], dtype=np.float32) @ q
+    elif embeddings_gpu is not None:
+        q = torch.from_numpy(np.ascontiguousarray(query_vecs)).to(device, dtype=embeddings_gpu.dtype)
+        all_scores = (q @ embeddings_gpu.T).float().cpu().numpy()
+    else:
+        all_scores = _similarity(embeddings, query_vecs)
+
+    # 除外条件のない質問向けに、全質問の上位k件を1回の部分選択でまとめて求めておく
+    top_parts = [None] * len(queries)
+    if 1 < len(queries) and 0 < k < all_scores.shape[1]:
+        top_parts = np.argpartition(all_scores, -k, axis=1)[:, -k:]
+
+    return [
+        _select_docs(query, scores, index_data, k, top_part)
+        for query, scores, top_part in zip(queries, all_scores, top_parts)
+    ]
+
+def _similarity(embeddings, query_vecs):
+    """
+    (質問数, 文書数) の類似度行列を返します。
+    float16 で保存した行列は SCORE_BLOCK_ROWS 行ずつ float32 に戻してから BLAS で計算します。
+    """
+    if embeddings.dtype == np.float32:
+        return query_vecs @ embeddings.T
+    n_docs, dim = embeddings.shape
+    out = np.empty((query_vecs.shape[0], n_docs), dtype=np.float32)
+    # 変換先のブロックと内積の出力先は使い回し、ブロックごとの一時配列を作らない
+    block_buf = np.empty((min(SCORE_BLOCK_ROWS, n_docs), dim), dtype=np.float32)
+    for start in range(0, n_docs, SCORE_BLOCK_ROWS):
+        stop = min(start + SCORE_BLOCK_ROWS, n_docs)
+        block = block_buf[:stop - start]
+        block[...] = embeddings[start:stop]
+        np.matmul(query_vecs, block.T, out=out[:, start:stop])
+    return out
+
+def _select_docs(query: str, scores, index_data, k: int, top_part=None):
+    """
+    1件の質問について、類似度と条件から上位k件の講義を選びます。
+    top_part は上位k件の番号（順不同）で、除外条件がない場合にだけ使います。
+    """
+    docs = index_data["docs"]
+
     # 3. 条件による調整（教授名フィルタ、時限ブースト）
-    exclude_prof = None
+    excluded = set()  # 除外する文書の番号
     if any(x in query for x in ["以外", "でない", "除いて"]):
-        prof_match = re.search(r'([一-龠]{2,4})教授', query)
-        if prof_match:
-            exclude_prof = prof_match.group(1)
-
-    # スコア順にソートして候補を抽出
-    sorted_indices = np.argsort(scores)[::-1]
-    results = []
-    
-    for idx in sorted_indices:
-        doc = docs[idx]
-        # 否定条件の適用
-        if exclude_prof and exclude_prof in doc['professor']:
-            continue
-            
-        # 「1限」などの時限キーワードの一致による加点
-        time_keywords = ["1限", "１限", "2限", "２限", "3限", "３限", "4限", "４限", "5限", "５限"]
-        for tk in time_keywords:
-            if tk in query and tk[0] in doc['period']:
-                scores[idx] += 0.1 # スコアを底上げ
-        
-        results.append(doc)
-        if len(results) >= k:
-            break
-            
-    return results
-
-def build_prompt_with_rag(system: str, history: list, user_input: str, retrieved_docs: list) -> str:
-    """既存のプロンプト形式を維持"""
-    pieces = [f"{system}\n"] if system else []
-    if retrieved_docs:
-        pieces.append("【関連する講義情報】")
-        for i, doc in enumerate(retrieved_docs, 1):
-            pieces.append(f"講義{i}: {doc['text'][:300]}") # 長すぎないよう制限
-        pieces.append("-" * 20 + "\n")
-    
-    pieces.append("これまでの対話:")
-    for role, text in history:
-        pieces.append(f"{role.capitalize()}: {text}")
-    pieces.append(f"User: {user_input}\nAssistant:")
-    return "\n".join(pieces)
+        # DBに載っている教授名（氏名・姓）を質問文から一度に探し、担当講義を索引から引く
+        prof_to_docs = index_data.get("prof_to_docs", {})
+        for key in match_professors(index_data.get("professor_matcher"), query):
+            excluded.update(prof_to_docs.get(key, ()))
+        if not excluded:
+            prof_match = _PROF_SUFFIX_RE.search(query)
+            if prof_match:
+                name = prof_match.group(1)
+                professors_norm = index_data.get("professors_norm")
+                if professors_norm is None:
+                    professors_norm = np.array(["".join(doc['professor'].split()) for doc in docs], dtype=str)
+                excluded = set(np.flatnonzero(np.char.find(professors_norm, name) >= 0).tolist())
+
+    # 質問に含まれる時限キーワードの加点は、候補選びの前に全講義へまとめて加える
+    time_cols = [j for j, tk in enumerate(TIME_KEYWORDS) if tk in query]
+    if time_cols:
+        bits = index_data.get("period_bits")
+        if bits is None:
+            bits = period_bits(docs)
+        scores = scores + TIME_BOOST * bits[:, time_cols].sum(axis=1)
+
+    # 除外する文書は候補選びの前にスコアを最低にしておき、上位k件だけを部分選択してから並べ替える
+    if excluded:
+        if not time_cols:
+            scores = scores.copy()
+        scores[list(excluded)] = -np.inf
+    kk = min(k, scores.size - len(excluded))
+    if not excluded and not time_cols and top_part is not None:
+        sorted_indices = top_part[np.argsort(scores[top_part])[::-1]]
+    elif 0 < kk < scores.size:
+        part = np.argpartition(scores, -kk)[-kk:]
+        sorted_indices = part[np.argsort(scores[part])[::-1]]
+    else:
+        sorted_indices = np.argsort(scores)[::-1]
+    # 否定条件で除外した講義と BM25 の候補外の講義は -inf なので、候補の末尾に回っている。
+    # 除外で候補が k 件を切った場合も、それらは結果に含めない
+    return [docs[idx] for idx in sorted_indices[:k] if np.isfinite(scores[idx])]
 
 def retrieve(query: str, db_wrapper, k: int = 3):
-    """フォールバック用"""
-    return retrieve_tfidf(query, db_wrapper, k)
+    """
+    フォールバック用のキーワード検索（埋め込みインデックスがない場合に使用）。
+    質問文を simple_tokenize で語に分け、含まれる語の種類数が多い講義から順に返します。
+    pyahocorasick があれば、質問の語から作ったオートマトンで各講義を1回の走査で照合します。
+    """
+    if not db_wrapper or "docs" not in db_wrapper: return []
+    if "embeddings" in db_wrapper:
+        # 埋め込みインデックスが渡された場合はベクトル検索を使う
+        return retrieve_tfidf(query, db_wrapper, k)
+
+    docs = db_wrapper["docs"]
+    terms = {t.lower() for t in simple_tokenize(query)}
+    if not terms:
+        return []
+
+    # 小文字化した本文は読み込み時に作ってある（外部から渡された docs はここで作る。db_wrapper は書き換えない）
+    contents = [doc.get('lower_text') or doc['text'].lower() for doc in docs]
+
+    if AHOCORASICK_AVAILABLE:
+        automaton = ahocorasick.Automaton()
+        for term in terms:
+            automaton.add_word(term, term)
+        automaton.make_automaton()
+        scores = [len({t for _, t in automaton.iter(content)}) for content in contents]
+    else:
+        scores = [sum(1 for t in terms if t in content) for content in contents]
+
+    # 同点の場合は元の並び順を保つ
+    ranked = sorted((i for i, score in enumerate(scores) if score > 0), key=lambda i: -scores[i])
+    return [docs[i] for i in ranked[:k]]
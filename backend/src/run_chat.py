@@ -1,37 +1,64 @@
 # main.py
 from types import SimpleNamespace
 from cli_chat import ChatSession
+from rag import get_model
 import os
+import threading
 
 # プロジェクトルートを BASE_DIR として設定
 # run_chat.py は backend/src にあるので、3 階層上がプロジェクトルートになります
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", ".."))
 
-def get_ai_response_one_shot(current_history, new_input):
-    # 1. 設定とモデルのロード（起動時に1回だけ行う）
-    # ※ここが重い処理なので、ループの外で行うのがポイントです
-    config = SimpleNamespace(
-        model="dsasai/llama3-elyza-jp-8b",
-        system="あなたは親切なAIです。",
-        prompt_template="default",
-        history_size=12,
-        no_langchain=False,
-        rag=True,
-        rag_db=os.path.join(BASE_DIR, "duec/database", "syllabus_all.csv"), 
-        rag_k=3,
-        rag_method="tfidf"
-    )
-
-    # セッションを作成（ここでモデル準備完了）
-    bot = ChatSession(config)
-
-    # 2. 1回ずつ呼ぶためのラッパー関数
+# 設定（サーバーからの全リクエストで共通）
+CONFIG = SimpleNamespace(
+    model="dsasai/llama3-elyza-jp-8b",
+    system="あなたは親切なAIです。",
+    prompt_template="default",
+    history_size=12,
+    no_langchain=False,
+    rag=True,
+    rag_db=os.path.join(BASE_DIR, "duec/database", "syllabus_all.csv"), 
+    rag_k=3,
+    rag_method="tfidf"
+)
+
+# セッション（RAG DB・インデックス・LLMクライアント）はプロセス内で1つだけ作り、全リクエストで使い回す
+_bot = None
+_bot_lock = threading.Lock()
+
+def get_session() -> ChatSession:
+    """共有の ChatSession を返す。初回呼び出し時にだけ作成する（重い処理）"""
+    global _bot
+    if _bot is None:
+        with _bot_lock:
+            if _bot is None:
+                _bot = ChatSession(CONFIG)
+    return _bot
+
+def warmup():
+    """
+    最初のリクエストが来る前にセッションを作り、埋め込みモデルも読み込んでおく。
+    短い質問で検索と応答生成を1回ずつ通し、CUDA カーネルの初期化や LLM のロードも済ませる。
+    サーバーの起動時に呼ぶ。
+    """
+    bot = get_session()
+    if bot.rag_index is not None:
+        get_model()
+    # 応答は捨てる。LLM に接続できない場合もエラー文字列が返るだけで起動は続ける
+    bot.chat("ping", history=[])
 
+def get_ai_response_one_shot(current_history, new_input):
     """
     履歴と入力を渡すと、応答だけを返してくれる関数
     """
-    response = bot.chat(new_input, history=current_history)
-    return response
+    # 履歴は呼び出し元が管理するので、共有セッションの内部履歴は使わない
+    return get_session().chat(new_input, history=current_history)
+
+def get_ai_response_stream(current_history, new_input):
+    """
+    get_ai_response_one_shot のストリーミング版。応答の断片を生成された順に yield する
+    """
+    return get_session().chat(new_input, history=current_history, stream=True)
 
 # history = [
 #     ("user", "アルゴリズムとデータ構造の評価方法を教えて。"), 
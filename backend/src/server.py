@@ -1,12 +1,21 @@
 # app.py
 import json
-from flask import Flask, request, Response, jsonify
+import os
+from flask import Flask, request, Response, jsonify, stream_with_context
 from flask_cors import CORS
 
-# run_chat.py を編集せずにそのまま利用（import時に末尾のprintが走る点に注意）
+# torch の読み込み（run_chat -> rag）より前に設定する。
+# 質問ごとに大きさの変わる小さなバッチでも CUDA メモリの断片化を抑える
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
+# run_chat.py の共有セッションを利用（セッションは初回のリクエストか warmup() で作成される）
 import run_chat
+import rag
 
 app = Flask(__name__)
+# 同時に届いた /chat の質問をまとめて1回でベクトル化する
+# （設定するだけで、ワーカースレッドは最初の質問のベクトル化時にワーカープロセス内で起動する）
+rag.enable_query_batching()
 CORS(app)
 
 def parse_history_param(current_history_str: str):
@@ -44,10 +53,10 @@ def chat():
     except Exception as e:
         return jsonify(error=f"invalid current_history: {e}"), 400
 
-    # run_chat.py の関数をそのまま呼ぶ
-    response_text = run_chat.get_ai_response_one_shot(history, new_input)
+    # 応答は生成された断片から順に返し、全文の生成完了を待たせない
+    chunks = run_chat.get_ai_response_stream(history, new_input)
 
-    return Response(response_text, mimetype="text/plain; charset=utf-8")
+    return Response(stream_with_context(chunks), mimetype="text/plain; charset=utf-8")
 
 @app.get("/healthz")
 def healthz():
@@ -58,7 +67,20 @@ def add_cors_headers(resp):
     resp.headers["Access-Control-Allow-Origin"] = "*"
     return resp
 
+# 本番では gunicorn のスレッドで並行に処理する（モデルを1つだけ読み込むためワーカーは1つ）:
+#   DUEC_WARMUP=1 gunicorn -w 1 --threads 8 server:app
+# --preload は使わない（マスターで初期化した CUDA はフォーク後のワーカーで使えない）。
+# import しただけでモデルの読み込みや LLM への問い合わせが走らないよう、
+# WSGI サーバー経由の事前読み込みは DUEC_WARMUP=1 のときだけ行う。
+if __name__ != "__main__" and os.environ.get("DUEC_WARMUP") == "1":
+    run_chat.warmup()
+
 if __name__ == "__main__":
+    debug = True
+    # 最初のリクエストを待たずにセッションとモデルを読み込む
+    # （debug のリローダーでは、監視用の親プロセスでは読み込まない）
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        run_chat.warmup()
     # Run on 127.0.0.1:5001 to avoid macOS services (AirPlay/Control Center)
-    app.run(host="127.0.0.1", port=5001, debug=True)
+    app.run(host="127.0.0.1", port=5001, debug=debug)
 
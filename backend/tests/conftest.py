@@ -0,0 +1,5 @@
+import os
+import sys
+
+# テストから backend/src のモジュールを import できるようにする
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from answer_cache import AnswerCache, context_key, doc_key, jaccard
+
+
+def _vec(angle_cos: float) -> np.ndarray:
+    """(1, 0) とのコサイン類似度が angle_cos になる2次元ベクトル"""
+    return np.array([angle_cos, np.sqrt(1.0 - angle_cos ** 2)], dtype=np.float32)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    c = AnswerCache(path=str(tmp_path / "answers.jsonl"), max_entries=4,
+                    sim_threshold=0.92, jaccard_threshold=0.8)
+    c.add("ctx", _vec(1.0), ["d1", "d2", "d3", "d4", "d5"], "reply")
+    return c
+
+
+def test_jaccard():
+    assert jaccard(frozenset(), frozenset()) == 1.0
+    assert jaccard(frozenset("ab"), frozenset("bc")) == pytest.approx(1 / 3)
+
+
+def test_hit_at_thresholds(cache):
+    # 類似度はしきい値 0.92 をわずかに上回り、Jaccard 4/5 = 0.8 はしきい値ちょうどなのでヒット
+    assert cache.lookup("ctx", _vec(0.921), ["d1", "d2", "d3", "d4"]) == "reply"
+
+
+def test_miss_below_similarity_threshold(cache):
+    assert cache.lookup("ctx", _vec(0.91), ["d1", "d2", "d3", "d4", "d5"]) is None
+
+
+def test_miss_below_jaccard_threshold(cache):
+    # 4/6 < 0.8: 言い換えでも根拠の講義が変わったら再生成させる
+    assert cache.lookup("ctx", _vec(1.0), ["d1", "d2", "d3", "d4", "d6"]) is None
+
+
+def test_miss_on_other_context(cache):
+    assert cache.lookup("other", _vec(1.0), ["d1", "d2", "d3", "d4", "d5"]) is None
+
+
+def test_best_match_wins(cache):
+    cache.add("ctx", _vec(0.95), ["d1", "d2", "d3", "d4", "d5"], "closer")
+    assert cache.lookup("ctx", _vec(0.95), ["d1", "d2", "d3", "d4", "d5"]) == "closer"
+
+
+def test_eviction_and_reload(cache, tmp_path):
+    for i in range(4):
+        cache.add("ctx", _vec(0.0), [f"x{i}"], f"r{i}")
+    assert len(cache.entries) == 4
+    assert cache.lookup("ctx", _vec(1.0), ["d1", "d2", "d3", "d4", "d5"]) is None
+
+    reloaded = AnswerCache(path=cache.path, max_entries=4)
+    assert [e[3] for e in reloaded.entries] == ["r0", "r1", "r2", "r3"]
+    assert reloaded.lookup("ctx", _vec(0.0), ["x3"]) == "r3"
+
+
+def test_keys_are_stable():
+    doc = {"text": "【科目名】 情報工学"}
+    assert doc_key(doc) == doc_key(dict(doc))
+    assert context_key("m", "sys", [("user", "a")]) == context_key("m", "sys", [["user", "a"]])
+    assert context_key("m", "sys", [("user", "a")]) != context_key("m", "sys", [("user", "b")])
@@ -0,0 +1,77 @@
+import argparse
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("FlagEmbedding")
+
+import cli_chat
+
+
+CSV = "科目名,教授名,概要\n情報工学,佐藤 太郎,プログラミング\n機械学習,鈴木 一郎,統計\n"
+
+
+@pytest.fixture
+def session(tmp_path, monkeypatch):
+    path = tmp_path / "db.csv"
+    path.write_text(CSV, encoding="utf-8-sig")
+    args = argparse.Namespace(
+        model="test-model", system="", prompt_template="default", history_size=6,
+        no_langchain=True, rag=True, rag_db=str(path), rag_k=2, rag_method="simple",
+        answer_cache=False,
+    )
+    return cli_chat.ChatSession(args)
+
+
+@pytest.fixture
+def retrieve_calls(monkeypatch):
+    """cli_chat.retrieve の呼び出しを記録する（結果は本物の retrieve のまま）"""
+    calls = []
+    original = cli_chat.retrieve
+
+    def counting_retrieve(query, db_wrapper, k=3):
+        calls.append(query)
+        return original(query, db_wrapper, k)
+
+    monkeypatch.setattr(cli_chat, "retrieve", counting_retrieve)
+    return calls
+
+
+def test_normalize_query():
+    assert cli_chat.normalize_query("  Python\tの 授業\n") == "python の 授業"
+
+
+def test_retrieval_cache_hit_on_normalized_query(session, retrieve_calls):
+    first = session._retrieve("プログラミング の授業")
+    second = session._retrieve("  プログラミング   の授業 ")
+
+    assert retrieve_calls == ["プログラミング の授業"]
+    assert second is first
+
+
+def test_retrieval_cache_miss_on_different_k(session, retrieve_calls):
+    session._retrieve("統計")
+    session.args.rag_k = 1
+    session._retrieve("統計")
+
+    assert len(retrieve_calls) == 2
+
+
+def test_retrieval_cache_cleared_on_reload(session, retrieve_calls):
+    session._retrieve("統計")
+    session._get_rag_prefix(session._retrieve("統計"))
+    session.load_rag_db()
+
+    assert session._rag_prefix_key is None
+    session._retrieve("統計")
+    assert len(retrieve_calls) == 2
+
+
+def test_retrieval_cache_evicts_oldest(session, retrieve_calls, monkeypatch):
+    monkeypatch.setattr(cli_chat, "RETRIEVAL_CACHE_SIZE", 2)
+    for q in ("a", "b", "c"):
+        session._retrieve(q)
+    session._retrieve("c")
+    session._retrieve("a")
+
+    assert retrieve_calls == ["a", "b", "c", "a"]
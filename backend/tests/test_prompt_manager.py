@@ -0,0 +1,85 @@
+import pytest
+
+from prompt_manager import _compile_template, get_default_template, render_prompt_template
+
+
+def format_reference(template_str: str, **kwargs) -> str:
+    """解析済みテンプレート導入前の str.format による実装（比較の基準）"""
+    kwargs.setdefault("system_instruction", "")
+    try:
+        return template_str.format(**kwargs)
+    except KeyError:
+        return template_str
+
+
+# 解析済みテンプレート（_compile_template）で処理されるもの
+COMPILED_TEMPLATES = [
+    "",
+    "固定の指示のみ",
+    "{system_instruction}",
+    "前置き\n{system_instruction}\n後書き",
+    "{{エスケープ}} {system_instruction} }}{{",
+    "{{system_instruction}}",
+    "{{{system_instruction}}}",
+    "{course} / {system_instruction} / {course}",
+    "{a}{b}",
+]
+
+# str.format にそのまま任せるもの
+FALLBACK_TEMPLATES = [
+    "{system_instruction!r}",
+    "{system_instruction:>5}",
+    "{x.y}",
+]
+
+KWARGS_CASES = [
+    {},
+    {"system_instruction": ""},
+    {"system_instruction": "追加の指示"},
+    {"system_instruction": "{not a placeholder}"},
+    {"course": "情報工学"},
+    {"course": 3, "system_instruction": "x"},
+    {"a": "A"},
+    {"a": "A", "b": "B"},
+    {"unused": "value"},
+]
+
+
+@pytest.mark.parametrize("template_str", COMPILED_TEMPLATES)
+def test_compiled_templates_are_compiled(template_str):
+    assert _compile_template(template_str) is not None
+
+
+@pytest.mark.parametrize("template_str", FALLBACK_TEMPLATES)
+def test_other_syntax_falls_back(template_str):
+    assert _compile_template(template_str) is None
+
+
+@pytest.mark.parametrize("kwargs", KWARGS_CASES)
+@pytest.mark.parametrize("template_str", COMPILED_TEMPLATES + FALLBACK_TEMPLATES)
+def test_render_matches_str_format(template_str, kwargs):
+    expected = format_reference(template_str, **kwargs)
+    assert render_prompt_template({"system_template": template_str}, **kwargs) == expected
+
+
+def test_missing_variable_returns_raw_template():
+    template_str = "{course}: {system_instruction}"
+    assert render_prompt_template({"system_template": template_str}, system_instruction="x") == template_str
+
+
+def test_render_does_not_mutate_kwargs():
+    kwargs = {"course": "情報工学"}
+    render_prompt_template({"system_template": "{course}{system_instruction}"}, **kwargs)
+    assert kwargs == {"course": "情報工学"}
+
+
+def test_default_template_renders():
+    template = get_default_template()
+    assert render_prompt_template(template) == format_reference(template["system_template"])
+    assert render_prompt_template(template, system_instruction="追加") == \
+        format_reference(template["system_template"], system_instruction="追加")
+
+
+def test_empty_template_dict():
+    assert render_prompt_template({}) == ""
+    assert render_prompt_template(None) == ""
@@ -0,0 +1,182 @@
+import json
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("FlagEmbedding")
+
+import rag
+
+
+RAGGED_CSV = "科目名,教授名,概要\nA,佐藤 太郎,x\nB,鈴木 一郎,y,extra\nC,田中 花子\n"
+
+
+@pytest.mark.parametrize("use_pandas", [True, False])
+def test_read_csv_rows_ragged(tmp_path, monkeypatch, use_pandas):
+    """列数の合わない行があっても、csv.DictReader と同じように全行を読む"""
+    if use_pandas and not rag.PANDAS_AVAILABLE:
+        pytest.skip("pandas not installed")
+    monkeypatch.setattr(rag, "PANDAS_AVAILABLE", use_pandas)
+    path = tmp_path / "db.csv"
+    path.write_text(RAGGED_CSV, encoding="utf-8-sig")
+
+    rows = rag._read_csv_rows(str(path))
+
+    assert rows == [
+        {"科目名": "A", "教授名": "佐藤 太郎", "概要": "x"},
+        {"科目名": "B", "教授名": "鈴木 一郎", "概要": "y"},
+        {"科目名": "C", "教授名": "田中 花子", "概要": ""},
+    ]
+
+
+def test_load_course_db_from_csv_ragged(tmp_path):
+    path = tmp_path / "db.csv"
+    path.write_text(RAGGED_CSV, encoding="utf-8-sig")
+
+    db = rag.load_course_db_from_csv(str(path))
+
+    assert db is not None
+    assert [doc["title"] for doc in db["docs"]] == ["A", "B", "C"]
+
+
+def _doc(title, professor="", period=""):
+    return {"title": title, "professor": professor, "period": period, "text": title}
+
+
+# テスト用の質問 -> 質問ベクトル
+VECS = {
+    "x": np.array([1.0, 0.0], dtype=np.float32),
+    "y": np.array([0.0, 1.0], dtype=np.float32),
+}
+
+
+@pytest.fixture
+def fake_encoder(monkeypatch):
+    """質問ごとに決まったベクトルを返す encode_queries（呼び出された質問を記録する）"""
+    calls = []
+
+    def encode_queries(queries):
+        queries = list(queries)
+        calls.extend(queries)
+        return np.stack([VECS[q] for q in queries])
+
+    monkeypatch.setattr(rag, "encode_queries", encode_queries)
+    rag._retrieve_tfidf_cached.cache_clear()
+    return calls
+
+
+def _index(titles, rows):
+    embeddings = rag.normalize_rows(np.array(rows, dtype=np.float32))
+    return rag._build_index(embeddings, [_doc(t) for t in titles], cache_hit=False)
+
+
+def test_retrieve_tfidf_cache_hit(fake_encoder):
+    index = _index(["A", "B"], [[1, 0], [0, 1]])
+
+    first = rag.retrieve_tfidf("x", index, k=1)
+    second = rag.retrieve_tfidf("x", index, k=1)
+
+    assert [d["title"] for d in first] == ["A"]
+    assert second == first
+    assert fake_encoder == ["x"]
+    # k が違えば別の結果としてキャッシュする
+    rag.retrieve_tfidf("x", index, k=2)
+    assert fake_encoder == ["x", "x"]
+
+
+def test_retrieve_tfidf_cache_invalidated_by_build_index(fake_encoder):
+    old = _index(["A", "B"], [[1, 0], [0, 1]])
+    assert [d["title"] for d in rag.retrieve_tfidf("x", old, k=1)] == ["A"]
+
+    new = _index(["C", "D"], [[0, 1], [1, 0]])
+    assert [d["title"] for d in rag.retrieve_tfidf("x", new, k=1)] == ["D"]
+    assert fake_encoder == ["x", "x"]
+    assert rag._retrieve_tfidf_cached.cache_info().currsize == 1
+
+
+def test_retrieve_tfidf_stale_index_not_cached(fake_encoder):
+    old = _index(["A", "B"], [[1, 0], [0, 1]])
+    _index(["C", "D"], [[0, 1], [1, 0]])
+
+    # 最新でないインデックスも検索できるが、結果はキャッシュしない
+    assert [d["title"] for d in rag.retrieve_tfidf("y", old, k=1)] == ["B"]
+    assert [d["title"] for d in rag.retrieve_tfidf("y", old, k=1)] == ["B"]
+    assert fake_encoder == ["y", "y"]
+
+
+@pytest.fixture(params=[False, True], ids=["regex", "ahocorasick"])
+def use_ahocorasick(request, monkeypatch):
+    if request.param and not rag.AHOCORASICK_AVAILABLE:
+        pytest.skip("pyahocorasick not installed")
+    monkeypatch.setattr(rag, "AHOCORASICK_AVAILABLE", request.param)
+    return request.param
+
+
+@pytest.mark.parametrize("text, expected", [
+    # 氏名の中の姓は、氏名と重なるので別に数えない
+    ("佐藤健哉教授以外", {"佐藤健哉"}),
+    ("佐藤教授以外", {"佐藤"}),
+    ("佐藤健哉と佐藤以外", {"佐藤健哉", "佐藤"}),
+    ("鈴木一郎先生と佐藤健哉先生", {"鈴木一郎", "佐藤健哉"}),
+    # 左から順に選ぶので、先に始まる一致が後ろの重なる一致より優先される
+    ("佐藤健哉一郎", {"佐藤健哉"}),
+    ("教授以外", set()),
+])
+def test_match_professors_non_overlapping(use_ahocorasick, text, expected):
+    keys = set().union(*(rag.professor_keys(name) for name in ["佐藤 健哉", "鈴木 一郎", "健哉一郎"]))
+    matcher = rag.build_professor_matcher(keys)
+    assert rag.match_professors(matcher, text) == expected
+
+
+def test_match_professors_without_keys(use_ahocorasick):
+    assert rag.build_professor_matcher(set()) is None
+    assert rag.match_professors(None, "佐藤以外") == set()
+
+
+def test_csv_doc_text(tmp_path):
+    path = tmp_path / "db.csv"
+    header = "科目名,学科,教授名,開講学期,曜日・時限,単位数,授業形態,概要,授業計画,成績評価基準,成績評価結果\n"
+    row = ('情報工学,工学科,佐藤 太郎,春学期,月曜日1講時,2,講義,概要文,'
+           '"[{""授業回"": 1, ""内容"": ""導入""}, {""内容"": ""演習""}]",'
+           '"[{""項目"": ""試験"", ""割合"": ""60%"", ""詳細"": ""期末""}]",'
+           '"{""A"": 10, ""B"": 20}"\n')
+    path.write_text(header + row, encoding="utf-8-sig")
+
+    doc = rag.load_course_db_from_csv(str(path))["docs"][0]
+
+    assert doc["text"] == (
+        "【科目名】 情報工学\n"
+        "【学科】 工学科\n"
+        "【担当教授】 佐藤 太郎\n"
+        "【基本情報】 春学期 / 月曜日1講時 / 2単位 / 講義\n"
+        "【概要】\n概要文\n"
+        "【授業計画】\n  第1回: 導入\n  第?回: 演習\n"
+        "【成績評価基準】\n  - 試験 (60%): 期末\n"
+        "【成績実績】 A: 10, B: 20"
+    )
+    assert doc["preview"] == doc["text"][:rag.PREVIEW_LEN]
+    assert doc["lower_text"] == doc["text"].lower()
+
+
+def test_json_doc_text(tmp_path):
+    path = tmp_path / "db.json"
+    path.write_text(json.dumps([
+        {"科目名": "機械学習", "教授名": "鈴木 一郎", "開講学期": "秋学期", "概要": "概要文",
+         "授業計画": [{"授業回": 1, "内容": "導入"}],
+         "成績評価基準": [{"項目": "レポート", "割合": "100%", "詳細": "毎週"}]},
+        # 末尾の見出しに項目がない場合も見出しは残る
+        {"科目名": "空の計画", "授業計画": []},
+    ], ensure_ascii=False), encoding="utf-8")
+
+    docs = rag.load_course_db(str(path))["docs"]
+
+    assert docs[0]["text"] == (
+        "【科目名】 機械学習\n"
+        "【担当教授】 鈴木 一郎\n"
+        "【開講】 秋学期 \n"
+        "【概要】\n概要文\n"
+        "【授業計画】\n  第1回: 導入\n"
+        "【成績評価基準】\n  - レポート (100%): 毎週"
+    )
+    assert docs[1]["text"] == "【科目名】 空の計画\n【授業計画】"
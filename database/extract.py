@@ -1,10 +1,27 @@
 import re
 import json
 import csv
+import functools
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 from bs4 import BeautifulSoup
 
+# lxml（libxml2 の C 実装）があればパーサーに使う。無ければ標準の html.parser
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+# orjson があれば JSON の書き出しに使う（C実装で、UTF-8 のバイト列を直接返す）
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
 
 # このスクリプトファイルと同じディレクトリをシラバスフォルダとして扱う
 try:
@@ -13,8 +30,62 @@ except NameError:
     # Jupyter 等で __file__ が無い場合のフォールバック
     SYLLABUS_DIR = Path(".").resolve()
 
+# 解析に使う正規表現（ファイルごとに使うので、モジュール読み込み時に一度だけコンパイルする）
+_RE_FLOAT_RIGHT = re.compile(r"float:right")
+# ヘッダー行「2024年度 (金曜日1講時) 面接/Face-to-face」のカッコ内と、その後ろを1回の走査で取る
+# （カッコの後ろは改行を含んでもよく、どんな内容でも曜日・時限は必ず取れるようにする）
+_RE_HEADER = re.compile(r"\(([^)]+)\)\s*(.*)", re.S)
+_RE_NAME_MARK = re.compile(r"^[○△●◎◇◆☆★\s]+")
+_RE_UNITS = re.compile(r"(\d+)単位")
+_RE_SEMESTER = re.compile(r"(春学期|秋学期|前期|後期|通年)")
+# 「講義・演習」が「講義」で先に一致しないよう、長い候補を先に並べる
+_RE_FORMAT = re.compile(r"(講義・演習|講義・実習|ゼミナール|講義|演習|実験|実習)")
+_RE_SPACES = re.compile(r"\s+")
+_RE_PERSON_NAME = re.compile(r"[一-龥々]{1,10}[　 ]+[一-龥々]{1,10}")
+
+
+@functools.lru_cache(maxsize=None)
+def _label_re(label_keyword: str):
+    """見出し文字列を含む b タグを探すための正規表現"""
+    return re.compile(re.escape(label_keyword))
+
+
+# locate_nodes で先に探しておく表の class
+_LOCATED_TABLE_CLASSES = ("show__content", "show__grades", "show__schedule")
+
+
+def locate_nodes(soup: BeautifulSoup) -> dict:
+    """
+    各パーサーが使う表と見出しの b タグを、文書全体の1回の走査でまとめて探す。
+    戻り値は {"show__content": table, ..., "labels": [b, ...]}（表はそれぞれ最初に現れたもの）。
+    パーサーはこれを nodes として受け取ると、文書を根から探し直さない。
+    """
+    nodes = {"labels": []}
+    for tag in soup.find_all(["table", "b"]):
+        if tag.name == "b":
+            if tag.string is not None:
+                nodes["labels"].append(tag)
+            continue
+        for cls in tag.get("class") or ():
+            if cls in _LOCATED_TABLE_CLASSES:
+                nodes.setdefault(cls, tag)
+    return nodes
+
+
+def _find_table(soup: BeautifulSoup, class_name: str, nodes: dict = None):
+    if nodes is None:
+        return soup.find("table", class_=class_name)
+    return nodes.get(class_name)
+
+
+def _find_label(soup: BeautifulSoup, label_keyword: str, nodes: dict = None):
+    if nodes is None:
+        return soup.find("b", string=_label_re(label_keyword))
+    return next((b for b in nodes["labels"] if label_keyword in b.string), None)
+
+
 # CSV に出す列の順番（対象学年は削除）
-FIELD_ORDER = [
+FIELD_ORDER = (
     "科目名",
     "開講学期",
     "曜日・時限",
@@ -27,10 +98,12 @@ FIELD_ORDER = [
     "授業計画",
     "成績評価基準",
     "成績評価結果",
-]
+)
+# CSV では JSON 文字列にして1セルに入れる列
+_JSON_KEYS = frozenset(("成績評価基準", "成績評価結果", "授業計画"))
 
 
-def parse_course_block(soup: BeautifulSoup) -> dict:
+def parse_course_block(soup: BeautifulSoup, nodes: dict = None) -> dict:
     """
     科目名 / 開講学期 / 曜日・時限 / 単位数 / 授業形態 / 実施方法 / 教授名 をまとめて取る。
     同志社シラバス HTML の構造に合わせた実装。
@@ -46,27 +119,28 @@ def parse_course_block(soup: BeautifulSoup) -> dict:
     }
 
     # --- 曜日・時限 + 実施方法（例：2024年度 (金曜日1講時) 面接/Face-to-face） ---
-    header_table = soup.find("table", class_="show__content")
+    header_table = _find_table(soup, "show__content", nodes)
     if header_table:
-        p_right = header_table.find("p", style=lambda v: v and "float:right" in v)
+        p_right = header_table.find("p", style=_RE_FLOAT_RIGHT)
         if p_right:
             header_text = p_right.get_text(" ", strip=True)
 
-            # (金曜日1講時) の中身 → 曜日・時限
-            m = re.search(r"\(([^)]+)\)", header_text)
+            m = _RE_HEADER.search(header_text)
             if m:
+                # (金曜日1講時) の中身 → 曜日・時限
                 result["曜日・時限"] = m.group(1)
 
-            # カッコ以降の部分 → 実施方法（面接/Face-to-face など）
-            m2 = re.search(r"\)\s*(.+)$", header_text)
-            if m2:
-                method_text = m2.group(1).strip()
+                # カッコ以降の部分 → 実施方法（面接/Face-to-face など）
+                method_text = (m.group(2) or "").strip()
                 if method_text:
                     result["実施方法"] = method_text
 
+    # 本文セルの一覧は科目情報と教授名の両方で使うので、木の走査は1回だけにする
+    content_tds = soup.select("td.show__content-in")
+
     # --- 科目名・単位数・開講学期・授業形態 ---
     course_info_td = None
-    for td in soup.select("td.show__content-in"):
+    for td in content_tds:
         if "単位/Unit" in td.get_text():
             course_info_td = td
             break
@@ -76,21 +150,21 @@ def parse_course_block(soup: BeautifulSoup) -> dict:
         font_tag = course_info_td.find("font")
         if font_tag:
             name = font_tag.get_text(strip=True)
-            name = re.sub(r"^[○△●◎◇◆☆★\s]+", "", name)
+            name = _RE_NAME_MARK.sub("", name)
             result["科目名"] = name
 
         # 単位/学期/授業形態： '単位/Unit' を含む <p> を探してそこから抜く
-        info_p = None
-        for p in course_info_td.find_all("p"):
-            if "単位/Unit" in p.get_text():
-                info_p = p
-                break
+        # （find_all で全 <p> のリストを作らず、子孫を文書順にたどって最初の一致で止める）
+        info_p = next(
+            (p for p in course_info_td.descendants if p.name == "p" and "単位/Unit" in p.get_text()),
+            None,
+        )
 
         if info_p:
             info_text = info_p.get_text(" ", strip=True)
 
             # 単位数（例：2単位/Unit）
-            m = re.search(r"(\d+)単位", info_text)
+            m = _RE_UNITS.search(info_text)
             if m:
                 try:
                     result["単位数"] = int(m.group(1))
@@ -98,12 +172,12 @@ def parse_course_block(soup: BeautifulSoup) -> dict:
                     result["単位数"] = m.group(1)
 
             # 開講学期（春学期/秋学期/前期/後期/通年 など）
-            m = re.search(r"(春学期|秋学期|前期|後期|通年)", info_text)
+            m = _RE_SEMESTER.search(info_text)
             if m:
                 result["開講学期"] = m.group(1)
 
             # 授業形態（講義/演習/実験/実習…）
-            m = re.search(r"(講義|演習|実験|実習|ゼミナール|講義・演習|講義・実習)", info_text)
+            m = _RE_FORMAT.search(info_text)
             if m:
                 result["授業形態"] = m.group(1)
 
@@ -116,18 +190,18 @@ def parse_course_block(soup: BeautifulSoup) -> dict:
         prof_td = soup.select_one('td.show__content-in table td[style*="text-align:right"]')
         if prof_td:
             name = prof_td.get_text(" ", strip=True)
-            name = re.sub(r"\s+", " ", name).strip()
+            name = _RE_SPACES.sub(" ", name).strip()
             # 明らかに教授名ではない文字列を弾く保険
             if name and "単位/Unit" not in name and "ディプロマ" not in name:
                 result["教授名"] = name
 
         # 最後の保険：氏名っぽい日本語パターン
         if not result["教授名"]:
-            for td in soup.select("td.show__content-in"):
+            for td in content_tds:
                 t = td.get_text(" ", strip=True)
                 if not t or "単位/Unit" in t:
                     continue
-                m = re.search(r"[一-龥々]{1,10}[　 ]+[一-龥々]{1,10}", t)
+                m = _RE_PERSON_NAME.search(t)
                 if m:
                     result["教授名"] = m.group(0).strip()
                     break
@@ -135,12 +209,12 @@ def parse_course_block(soup: BeautifulSoup) -> dict:
     return result
 
 
-def extract_section_text(soup: BeautifulSoup, label_keyword: str):
+def extract_section_text(soup: BeautifulSoup, label_keyword: str, nodes: dict = None):
     """
     ＜概要/..., ＜到達目標/..., などの見出し b タグの次の <p> をテキストで返す。
     label_keyword には "＜概要" や "＜到達目標" などを渡す。
     """
-    b = soup.find("b", string=lambda s: s and label_keyword in s)
+    b = _find_label(soup, label_keyword, nodes)
     if not b:
         return None
 
@@ -155,13 +229,13 @@ def extract_section_text(soup: BeautifulSoup, label_keyword: str):
     return " ".join(content_p.stripped_strings)
 
 
-def parse_evaluation_criteria(soup: BeautifulSoup):
+def parse_evaluation_criteria(soup: BeautifulSoup, nodes: dict = None):
     """
     ＜成績評価基準/Evaluation Criteria＞の表 (class="show__grades") を
     [ {項目, 割合, 詳細}, ... ] のリストにする。
     何も取れなければ None。
     """
-    table = soup.find("table", class_="show__grades")
+    table = _find_table(soup, "show__grades", nodes)
     if not table:
         return None
 
@@ -182,13 +256,13 @@ def parse_evaluation_criteria(soup: BeautifulSoup):
     return items or None
 
 
-def parse_grade_results(soup: BeautifulSoup):
+def parse_grade_results(soup: BeautifulSoup, nodes: dict = None):
     """
     ＜成績評価結果/Results of assessment＞の表を
     { '登録者数': ..., 'A': ..., ..., '備考': ... } の dict にする。
     何も取れなければ None。
     """
-    b = soup.find("b", string=lambda s: s and "＜成績評価結果" in s)
+    b = _find_label(soup, "＜成績評価結果", nodes)
     if not b:
         return None
 
@@ -219,12 +293,11 @@ def parse_grade_results(soup: BeautifulSoup):
         "評点平均値",
         "備考",
     ]
-    values = [td.get_text(strip=True) for td in data_tds[: len(keys)]]
-
-    return dict(zip(keys, values))
+    # 上で9列以上あることを確認済みなので、先頭から順にそのまま対応させる
+    return {key: td.get_text(strip=True) for key, td in zip(keys, data_tds)}
 
 
-def parse_schedule(soup: BeautifulSoup):
+def parse_schedule(soup: BeautifulSoup, nodes: dict = None):
     """
     ＜授業計画/Schedule＞から
     [
@@ -233,7 +306,7 @@ def parse_schedule(soup: BeautifulSoup):
     ]
     を返す。
     """
-    table = soup.find("table", class_="show__schedule")
+    table = _find_table(soup, "show__schedule", nodes)
     if not table:
         return None
 
@@ -241,15 +314,14 @@ def parse_schedule(soup: BeautifulSoup):
     if len(rows) <= 3:
         return None
 
-    # 先頭3行がヘッダの前提
-    data_rows = rows[3:]
-
     items = []
-    i = 0
+    # 先頭3行がヘッダの前提なので、4行目から rows を直接たどる（スライスのコピーを作らない）
+    i = 3
     # 週ごとに 3 行セット（1行目: 回など/ 2行目: 内容 / 3行目: 授業時間外学習）
-    while i + 1 < len(data_rows):
-        r1 = data_rows[i]
-        r2 = data_rows[i + 1]
+    # 回の列がない行は1行ずつ読み飛ばすので、固定幅の range にはしない
+    while i + 1 < len(rows):
+        r1 = rows[i]
+        r2 = rows[i + 1]
 
         tds1 = r1.find_all("td")
         if len(tds1) < 2:
@@ -274,17 +346,19 @@ def parse_syllabus_html(path: Path) -> dict:
     with path.open("r", encoding="utf-8", errors="ignore") as f:
         html = f.read()
 
-    soup = BeautifulSoup(html, "html.parser")
+    soup = BeautifulSoup(html, HTML_PARSER)
+    # 各パーサーが探す表・見出しは1回の走査でまとめて見つけておく
+    nodes = locate_nodes(soup)
 
-    base = parse_course_block(soup)
+    base = parse_course_block(soup, nodes)
 
-    overview = extract_section_text(soup, "＜概要")
-    goals = extract_section_text(soup, "＜到達目標")
+    overview = extract_section_text(soup, "＜概要", nodes)
+    goals = extract_section_text(soup, "＜到達目標", nodes)
 
-    eval_criteria = parse_evaluation_criteria(soup)
-    grade_results = parse_grade_results(soup)
+    eval_criteria = parse_evaluation_criteria(soup, nodes)
+    grade_results = parse_grade_results(soup, nodes)
 
-    schedule = parse_schedule(soup)
+    schedule = parse_schedule(soup, nodes)
 
     record = {
         "科目名": base.get("科目名"),
@@ -303,42 +377,75 @@ def parse_syllabus_html(path: Path) -> dict:
     return record
 
 
-def main():
-    all_records = []
+def _parse_syllabus_html_safe(path: Path):
+    """
+    プロセスプール用のラッパー。例外は親プロセスで表示できるよう文字列にして返す。
+    戻り値は (record, None) または (None, エラーメッセージ)。
+    """
+    try:
+        return parse_syllabus_html(path), None
+    except Exception as e:
+        return None, str(e)
+
+
+def _json_record(rec) -> bytes:
+    """
+    1件分（または CSV の1セル分）の JSON（UTF-8）。機械が読む出力なので、インデントや区切りの空白は付けない。
+    人が読むときは python -m json.tool syllabus_parsed.json で整形する。
+    """
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(rec)
+    return json.dumps(rec, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
 
+
+def _csv_cell(key: str, val):
+    if val is None:
+        return ""
+    # list/dict 系は JSON 文字列に変換して1セルに入れる
+    # （CSV の出力を変えないよう、JSON ファイルと違って既定の区切り ", " / ": " のままにする）
+    if key in _JSON_KEYS:
+        return json.dumps(val, ensure_ascii=False)
+    return val
+
+
+def _csv_row(rec: dict) -> list:
+    """FIELD_ORDER の順に並べた CSV の1行（csv.writer にそのまま渡す）"""
+    return [_csv_cell(key, rec.get(key)) for key in FIELD_ORDER]
+
+
+def main():
     # このスクリプトと同じディレクトリ内の *.html を全部読む
-    for path in SYLLABUS_DIR.glob("*.html"):
-        try:
-            rec = parse_syllabus_html(path)
-            all_records.append(rec)
-        except Exception as e:
-            print(f"Error parsing {path}: {e}")
-
-    # --- JSON 出力 ---
-    json_path = SYLLABUS_DIR / "syllabus_parsed.json"
-    with json_path.open("w", encoding="utf-8") as f:
-        json.dump(all_records, f, ensure_ascii=False, indent=2)
+    # 各ファイルの解析は独立しているので、CPU コア数分のプロセスで並列に行う（出力順はファイル名順）
+    paths = sorted(SYLLABUS_DIR.glob("*.html"))
+    # 1プロセスあたり4回程度に分けて渡し、プロセス間通信の回数と負荷の偏りを両方抑える
+    chunksize = max(1, len(paths) // (4 * (os.cpu_count() or 1)))
 
-    # --- CSV 出力 ---
+    json_path = SYLLABUS_DIR / "syllabus_parsed.json"
     # Excel で文字化けしにくい UTF-8 with BOM
     # もし環境的に Shift_JIS が必要なら "cp932" に変更
     csv_path = SYLLABUS_DIR / "syllabus_parsed.csv"
-    with csv_path.open("w", newline="", encoding="utf-8-sig") as f:
-        writer = csv.DictWriter(f, fieldnames=FIELD_ORDER)
-        writer.writeheader()
-
-        for rec in all_records:
-            row = {}
-            for key in FIELD_ORDER:
-                val = rec.get(key)
-
-                # list/dict 系は JSON 文字列に変換して1セルに入れる
-                if key in ("成績評価基準", "成績評価結果", "授業計画"):
-                    row[key] = "" if val is None else json.dumps(val, ensure_ascii=False)
-                else:
-                    row[key] = "" if val is None else val
-
-            writer.writerow(row)
+
+    # 解析できた順に JSON（配列、1行1件）と CSV の両方へ書き出し、全件をメモリに溜めない
+    n_records = 0
+    with ProcessPoolExecutor() as ex, \
+            json_path.open("wb") as json_f, \
+            csv_path.open("w", newline="", encoding="utf-8-sig") as csv_f:
+        # 行は FIELD_ORDER 順のリストで作るので、DictWriter の辞書→リスト変換は不要
+        writer = csv.writer(csv_f)
+        writer.writerow(FIELD_ORDER)
+        json_f.write(b"[")
+
+        for path, (rec, err) in zip(paths, ex.map(_parse_syllabus_html_safe, paths, chunksize=chunksize)):
+            if err is not None:
+                print(f"Error parsing {path}: {err}")
+                continue
+            if n_records:
+                json_f.write(b",\n")
+            json_f.write(_json_record(rec))
+            writer.writerow(_csv_row(rec))
+            n_records += 1
+
+        json_f.write(b"]")
 
     print(f"JSON: {json_path}")
     print(f"CSV : {csv_path}")